@@ -18,3 +18,23 @@ class AuthHederNotFound(Exception):
 
 class ExpiredSignatureError(Exception):
     pass
+
+
+class InvalidTokenTypeError(Exception):
+    pass
+
+
+class UploadNotFoundError(Exception):
+    pass
+
+
+class UploadOffsetError(Exception):
+    def __init__(self, offset):
+        super().__init__(f'upload offset mismatch, offset={offset}')
+        self.offset = offset
+
+
+class DigestMismatchError(Exception):
+    def __init__(self, algorithms):
+        super().__init__(f'content digest mismatch, algorithms={algorithms}')
+        self.algorithms = algorithms
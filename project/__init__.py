@@ -3,12 +3,14 @@ import click
 from flask import Flask, request, make_response, current_app, g
 from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate, stamp
 from werkzeug.datastructures import FileStorage
 
 from project.config import config_logging
 
 
 db = SQLAlchemy()
+migrate = Migrate()
 
 
 def create_app():
@@ -19,19 +21,56 @@ def create_app():
     config_logging()
 
     db.init_app(app)
+    migrate.init_app(app, db, directory=os.path.join(
+        os.path.dirname(__file__), 'migrations'))
+
+    from project.redis_pool import create_pool
+    app.extensions['redis_pool'] = create_pool(app)
+
+    from project.storage import create_storage
+    app.extensions['storage'] = create_storage(app)
+
+    from project.content.cache import ContentCache
+    app.extensions['content_cache'] = ContentCache(
+        app.extensions['redis_pool'],
+        app.config['CONTENT_CACHE_TTL'],
+        app.config['CONTENT_CACHE_LOCAL_SIZE'],
+        app.config['CONTENT_CACHE_LOCAL_TTL'])
+
+    from project.content.events import EventHub
+    app.extensions['content_events'] = EventHub(app.config['REDIS_CONN_URL'],
+                                                app.config['EVENTS_QUEUE_SIZE'],
+                                                app.config['EVENTS_MAX_STREAMS'])
+
+    from project.auth.cache import TokenCache, RevokedTokens
+    app.extensions['token_cache'] = TokenCache(app.config['TOKEN_CACHE_SIZE'],
+                                               app.config['TOKEN_CACHE_TTL'])
+    app.extensions['revoked_tokens'] = RevokedTokens(
+        app.config['TOKEN_REVOKED_REFRESH'],
+        app.config['TOKEN_REVOKED_OVERLAP'])
+
     app.cli.add_command(init_db_command)
+    app.cli.add_command(purge_tokens_command)
+    app.cli.add_command(apply_results_command)
+    app.cli.add_command(purge_blobs_command)
+    app.cli.add_command(purge_uploads_command)
 
-    from project import auth, account, content
+    from project import auth, account, content, metrics
     app.register_blueprint(auth.bp)
     app.register_blueprint(account.bp)
     app.register_blueprint(content.bp)
+    app.register_blueprint(metrics.bp)
 
     return app
 
 
 def init_db():
     db.drop_all()
+    db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    db.session.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+    db.session.commit()
     db.create_all()
+    stamp()
 
     from project import account
     from project import content
@@ -86,9 +125,61 @@ def init_db():
     db.session.add(created_content)
     db.session.commit()
 
+    from project.content.cache import invalidate
+    for acc in (admin_account, robot_account, regular_ready_account, regular_account):
+        invalidate(acc.id, [uploaded_content.uuid, created_content.uuid])
+
 
 @click.command("init-db")
 @with_appcontext
 def init_db_command():
     init_db()
-    click.echo("Initialized the database.")
+    click.echo("Initialized the database (development only, use 'flask db upgrade' "
+               "for live databases).")
+
+
+@click.command("purge-tokens")
+@click.option("--batch-size", default=1000, show_default=True)
+@with_appcontext
+def purge_tokens_command(batch_size):
+    from project.auth.models import BlacklistToken
+
+    purged = BlacklistToken.purge_expired(batch_size)
+    click.echo(f"Purged {purged} expired revoked tokens.")
+
+
+@click.command("apply-results")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--timeout", default=5, show_default=True)
+@click.option("--consumer", default=None,
+              help="Unique, stable consumer name, defaults to the hostname.")
+@with_appcontext
+def apply_results_command(batch_size, timeout, consumer):
+    from project.content.utils import apply_results
+
+    click.echo("Applying robot results...")
+    apply_results(batch_size, timeout, consumer=consumer)
+
+
+@click.command("purge-blobs")
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option("--grace", default=3600, show_default=True,
+              help="Seconds a blob must stay untouched before removal.")
+@with_appcontext
+def purge_blobs_command(batch_size, grace):
+    from project.content.models import Blob
+    from project.content.utils import purgeBlobs, get_storage
+
+    purged = purgeBlobs(Blob.unreferenced(batch_size), get_storage(), grace)
+    click.echo(f"Purged {purged} unreferenced blobs.")
+
+
+@click.command("purge-uploads")
+@click.option("--max-age", default=24, show_default=True,
+              help="Hours a staging file may stay untouched before removal.")
+@with_appcontext
+def purge_uploads_command(max_age):
+    from project.content.utils import purgeStaging
+
+    purged = purgeStaging(current_app.config['UPLOAD_FOLDER'], max_age * 3600)
+    click.echo(f"Purged {purged} abandoned upload staging files.")
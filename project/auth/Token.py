@@ -1,35 +1,98 @@
 import os
 import jwt
-from functools import wraps
+import time
+from functools import wraps, lru_cache
 from datetime import datetime, timedelta
 
-from flask import request, make_response, jsonify, g
+from flask import request, make_response, jsonify, g, current_app, has_app_context
 
 from project import config
 from .models import BlacklistToken
+from .cache import tokenHash
 from project.Exceptions import *
 
 
+@lru_cache(maxsize=None)
+def _configClass(app_config):
+    return getattr(config, app_config.split('.')[-1])
+
+
+def configClass():
+    return _configClass(os.getenv('APP_CONFIG', 'project.config.DevConfig'))
+
+
 def _token_required(authHeader):
     encoded_token = extractToken(authHeader)
-    payload = decodeToken(encoded_token)
+    payload = verifyToken(encoded_token)
+    if payload.get('type', 'access') != 'access':
+        raise InvalidTokenTypeError('invalid_token_type')
     if tokenRevoked(encoded_token):
         raise RevokedTokenError('access_token_revoked')
     return encoded_token, payload
 
 
+def _refresh_token_required(authHeader):
+    encoded_token = extractToken(authHeader)
+    payload = decodeToken(encoded_token)
+    if payload.get('type') != 'refresh':
+        raise InvalidTokenTypeError('invalid_token_type')
+    if tokenRevoked(encoded_token):
+        raise RevokedTokenError('refresh_token_revoked')
+    return encoded_token, payload
+
+
+def verifyToken(encoded_token):
+    cache = current_app.extensions.get('token_cache') \
+        if has_app_context() else None
+    if cache is None:
+        return decodeToken(encoded_token)
+
+    key = tokenHash(encoded_token)
+    payload = cache.get(key)
+    if payload is None:
+        payload = decodeToken(encoded_token)
+        cache.set(key, payload)
+    elif payload['exp'] <= time.time():
+        cache.discard(key)
+        raise ExpiredSignatureError("expired_signature_error")
+    return payload
+
+
 def tokenRevoked(authToken):
-    return bool(BlacklistToken.check_blacklist(authToken))
+    revoked = current_app.extensions.get('revoked_tokens') \
+        if has_app_context() else None
+    if revoked is None:
+        return bool(BlacklistToken.check_blacklist(tokenHash(authToken)))
+    return tokenHash(authToken) in revoked
+
+
+def revokeToken(authToken, payload):
+    blacklistToken = BlacklistToken(
+        token_hash=tokenHash(authToken),
+        expires_at=datetime.utcfromtimestamp(payload['exp']))
+    blacklistToken.save()
+    markRevoked(authToken, blacklistToken.expires_at)
+
 
+def markRevoked(authToken, expires_at):
+    if not has_app_context():
+        return
+
+    key = tokenHash(authToken)
+    if 'revoked_tokens' in current_app.extensions:
+        current_app.extensions['revoked_tokens'].add(key, expires_at)
+    if 'token_cache' in current_app.extensions:
+        current_app.extensions['token_cache'].discard(key)
+
+
+def encodeToken(expires_delta, account_id, role, token_type='access'):
+    config_class = configClass()
 
-def encodeToken(expires_delta, account_id, role):
-    app_config = os.getenv('APP_CONFIG', 'project.config.DevConfig')
-    config_class = getattr(config, app_config.split('.')[-1])
-    
     now = datetime.utcnow()
     payload = {
         'account_id': account_id,
         'role': role,
+        'type': token_type,
         'iat': now,
         'exp': now + expires_delta
     }
@@ -40,8 +103,7 @@ def encodeToken(expires_delta, account_id, role):
 
 
 def decodeToken(encodeToken):
-    app_config = os.getenv('APP_CONFIG', 'project.config.DevConfig')
-    config_class = getattr(config, app_config.split('.')[-1])
+    config_class = configClass()
 
     try:
         return jwt.decode(encodeToken,
@@ -56,6 +118,11 @@ def createAccessToken(accountId, role):
     return encodeToken(expires_delta, accountId, role)
 
 
+def createRefreshToken(accountId, role):
+    expires_delta = timedelta(days=configClass().REFRESH_TOKEN_DAYS)
+    return encodeToken(expires_delta, accountId, role, token_type='refresh')
+
+
 def extractToken(authHeader):
     if not authHeader:
         raise AuthHederNotFound('auth_header_not_found')
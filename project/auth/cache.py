@@ -0,0 +1,95 @@
+import time
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from threading import Lock
+from collections import OrderedDict
+
+from .models import BlacklistToken
+
+appLog = logging.getLogger("server.app")
+
+
+def tokenHash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class TokenCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            payload, expires = entry
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return payload
+
+    def set(self, key, payload):
+        with self.lock:
+            self.entries[key] = (payload, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class RevokedTokens:
+    def __init__(self, refresh_interval, overlap=60):
+        self.refresh_interval = refresh_interval
+        self.overlap = timedelta(seconds=overlap)
+        self.hashes = {}
+        self.since = None
+        self.refreshed_at = None
+        self.lock = Lock()
+
+    def fresh(self):
+        return self.refreshed_at is not None \
+            and time.monotonic() - self.refreshed_at < self.refresh_interval
+
+    def refresh(self, force=False):
+        if not force and self.fresh():
+            return
+
+        with self.lock:
+            # another request may have refreshed while this one waited
+            if not force and self.fresh():
+                return
+
+            now = time.monotonic()
+            # rows commit in any order, so re-read a window instead of an id watermark
+            started = datetime.now()
+            rows = BlacklistToken.revoked_since(self.since)
+            for token_hash, expires_at in rows:
+                self.hashes[token_hash] = expires_at
+
+            utcnow = datetime.utcnow()
+            self.hashes = {key: expires_at
+                           for key, expires_at in self.hashes.items()
+                           if expires_at > utcnow}
+            self.since = started - self.overlap
+            self.refreshed_at = now
+
+        if rows:
+            appLog.info(f"revoked tokens refresh, count={len(rows)}")
+
+    def add(self, key, expires_at):
+        with self.lock:
+            self.hashes[key] = expires_at
+
+    def __contains__(self, key):
+        self.refresh()
+        return key in self.hashes
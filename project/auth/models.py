@@ -14,8 +14,9 @@ class BlacklistToken(db.Model):
     __tabename__ = 'blacklist_tokens'
 
     id = db.Column(db.Integer, primary_key=True)
-    token = db.Column(db.String, unique=True, nullable=False)
-    blacklist_on = db.Column(db.DateTime, default=datetime.now)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    blacklist_on = db.Column(db.DateTime, default=datetime.now, index=True)
 
     def save(self):
         try:
@@ -28,13 +29,49 @@ class BlacklistToken(db.Model):
             raise
     
     @classmethod
-    def check_blacklist(cls, authToken):
+    def check_blacklist(cls, token_hash):
         try:
             return db.session\
-                .query(exists().where(cls.token == authToken))\
+                .query(exists().where(cls.token_hash == token_hash))\
                 .scalar()
         except SQLAlchemyError as e:
             errorLog.error(format_exc(type(e), e))
             raise
 
-    
+    @classmethod
+    def revoked_since(cls, since=None):
+        query = db.session\
+            .query(cls.token_hash, cls.expires_at)\
+            .filter(cls.expires_at > datetime.utcnow())
+        if since is not None:
+            query = query.filter(cls.blacklist_on >= since)
+
+        try:
+            return query.all()
+        except SQLAlchemyError as e:
+            errorLog.error(format_exc(type(e), e))
+            raise
+
+    @classmethod
+    def purge_expired(cls, batch_size=1000):
+        purged = 0
+        while True:
+            try:
+                ids = db.session\
+                    .query(cls.id)\
+                    .filter(cls.expires_at <= datetime.utcnow())\
+                    .limit(batch_size)\
+                    .subquery()
+                count = cls.query\
+                    .filter(cls.id.in_(ids))\
+                    .delete(synchronize_session=False)
+                db.session.commit()
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                errorLog.error(format_exc(type(e), e))
+                raise
+
+            purged += count
+            if count < batch_size:
+                appLog.info(f"revoked tokens purged, count={purged}")
+                return purged
@@ -1,12 +1,12 @@
 import logging
 import json
 from traceback import format_exception_only as format_exc
-from flask import Blueprint, g, request, jsonify
+from flask import Blueprint, g, request, jsonify, current_app
 
-from .models import BlacklistToken
 from project.account.models import Account
 from project.account.schemas import AccountShema
-from .Token import createAccessToken
+from .Token import createAccessToken, createRefreshToken, revokeToken, decodeToken,\
+    tokenRevoked, _refresh_token_required
 from project.utils import is_json, token_required
 from project.Exceptions import EntityNotFoundError
 
@@ -75,16 +75,57 @@ def login():
 
     accessToken = createAccessToken(account.id, account.role)
     app_log.info(f"login, username={account.username}")
+    if account.role in current_app.config['REFRESH_TOKEN_ROLES']:
+        refreshToken = createRefreshToken(account.id, account.role)
+        return jsonify(access_token=accessToken, refresh_token=refreshToken)
     return jsonify(access_token=accessToken)
 
 
-@bp.route('/logout')
+@bp.route('/refresh', methods=['POST'])
+def refresh():
+    try:
+        _, payload = _refresh_token_required(
+            request.headers.get("Authorization", None))
+    except Exception as e:
+        return jsonify(error=str(e)), 401
+
+    try:
+        account = Account.find_by_account_id(payload['account_id'])
+    except EntityNotFoundError:
+        return jsonify(error="invalid_refresh_token"), 401
+    except Exception:
+        return jsonify(), 500
+
+    if account.deleted or account.role not in current_app.config['REFRESH_TOKEN_ROLES']:
+        error_log.error(f"refresh not allowed, acc_id={account.id}, role={account.role}")
+        return jsonify(error="invalid_refresh_token"), 401
+
+    accessToken = createAccessToken(account.id, account.role)
+    app_log.info(f"token refresh, account_id={account.id}")
+    return jsonify(access_token=accessToken)
+
+
+@bp.route('/logout', methods=['GET', 'POST'])
 @token_required(json=True)
 def logout():
-    blackedlistToken = BlacklistToken(token=g.token)
+    refreshToken = (request.get_json(silent=True) or {}).get('refresh_token')
+    if refreshToken is not None:
+        try:
+            refreshPayload = decodeToken(refreshToken)
+        except Exception as e:
+            return jsonify(error=str(e)), 400
+        if refreshPayload.get('type') != 'refresh' \
+                or refreshPayload['account_id'] != g.payload['account_id']:
+            error_log.error(
+                f"logout invalid refresh token, account_id={g.payload['account_id']}")
+            return jsonify(error='invalid_refresh_token'), 400
+
     try:
-        blackedlistToken.save()
-        app_log.info(f"logout, account_id={g.payload['account_id']}")
+        revokeToken(g.token, g.payload)
+        if refreshToken is not None and not tokenRevoked(refreshToken):
+            revokeToken(refreshToken, refreshPayload)
+        app_log.info(f"logout, account_id={g.payload['account_id']}, "
+                     f"refresh_revoked={refreshToken is not None}")
         return jsonify(), 200
     except Exception:
         return jsonify(), 500
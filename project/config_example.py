@@ -7,13 +7,40 @@ class Config():
     SECRET_KEY = 'secret'
     JSON_SORT_KEYS = False
     UPLOAD_FOLDER = os.path.dirname(__file__)
+    STORAGE_BACKEND = 'local'
+    STORAGE_S3_BUCKET = None
+    STORAGE_S3_PREFIX = ''
+    STORAGE_S3_ENDPOINT_URL = None
+    STORAGE_CODEC = None
+    STORAGE_DEDUP = False
     SQLALCHEMY_DATABASE_URI = 'postgresql+psycopg2://postgres:@127.0.0.1/db'
     REDIS_CONN_URL = 'redis://:path@127.0.0.1:6379/0'
     REDIS_QUEUE = 'queue'
+    RESULTS_QUEUE = 'results'
+    REDIS_MAX_CONNECTIONS = 20
+    REDIS_POOL_TIMEOUT = 5
+    REDIS_HEALTH_CHECK_INTERVAL = 30
+    CONTENTS_PAGE_LIMIT = 100
+    CONTENTS_MAX_PAGE_LIMIT = 1000
+    CONTENTS_BATCH_LIMIT = 1000
+    CONTENT_CACHE_TTL = 300
+    CONTENT_CACHE_LOCAL_SIZE = 10000
+    CONTENT_CACHE_LOCAL_TTL = 5
+    EVENTS_STREAM_TIMEOUT = 300
+    EVENTS_HEARTBEAT = 15
+    EVENTS_QUEUE_SIZE = 100
+    EVENTS_MAX_STREAMS = 8
     ROBOT_PWD = 'robot_pwd'
     ADMIN_PWD = 'admin_pwd'
+    TOKEN_CACHE_SIZE = 10000
+    TOKEN_CACHE_TTL = 60
+    TOKEN_REVOKED_REFRESH = 5
+    TOKEN_REVOKED_OVERLAP = 60
+    REFRESH_TOKEN_DAYS = 30
+    REFRESH_TOKEN_ROLES = ('robot',)
     SQLALCHEMY_ECHO = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    MIGRATION_LOCK_TIMEOUT = '5s'
 
 
 class ProdConfig(Config):
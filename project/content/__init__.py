@@ -1,2 +1,2 @@
 from .view import bp
-from .models import Content
+from .models import Content, Blob
@@ -0,0 +1,154 @@
+import json
+import hashlib
+import logging
+
+import redis
+from flask import current_app
+
+from project.auth.cache import TokenCache
+
+appLog = logging.getLogger("server.app")
+errorLog = logging.getLogger("server.error")
+
+
+def queryHash(args):
+    query = json.dumps(sorted(args.items(multi=True)))
+    return hashlib.md5(query.encode('utf-8')).hexdigest()
+
+
+def bodyEtag(body):
+    raw = json.dumps(body, sort_keys=True, default=str)
+    return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+class ContentCache:
+    """Per-account document and listing cache.
+
+    Document keys carry the document's version and listing keys the account
+    generation, both read before the database query; invalidate bumps them,
+    so an entry filled from a read that raced with a write lands under the
+    old version and is never served. A write only retires the documents it
+    touched, listings go with every write.
+
+    If a bump cannot reach Redis, its entries there are stale: the cache is
+    bypassed for the account until a retried bump lands.
+    """
+
+    def __init__(self, pool, ttl, local_size, local_ttl, prefix='content'):
+        self.redis = redis.Redis(connection_pool=pool)
+        self.ttl = ttl
+        self.local = TokenCache(local_size, local_ttl)
+        self.local_generations = {}
+        self.pending = {}
+        self.prefix = prefix
+
+    def genKey(self, acc_id):
+        return f'{self.prefix}:gen:{acc_id}'
+
+    def verKey(self, acc_id, content_uuid):
+        return f'{self.prefix}:ver:{acc_id}:{content_uuid}'
+
+    def docKey(self, acc_id, version, content_uuid):
+        return f'{self.prefix}:doc:{acc_id}:{content_uuid}:{version}'
+
+    def listKey(self, acc_id, generation):
+        return f'{self.prefix}:list:{acc_id}:{generation}'
+
+    def generation(self, acc_id):
+        """Listing generation, or None while the cache must be bypassed."""
+        if self.stale(acc_id):
+            return None
+        try:
+            return int(self.redis.get(self.genKey(acc_id)) or 0)
+        except redis.RedisError:
+            return f'local{self.local_generations.get(acc_id, 0)}'
+
+    def version(self, acc_id, content_uuid):
+        """Document version, or None while the cache must be bypassed."""
+        if self.stale(acc_id):
+            return None
+        try:
+            return int(self.redis.get(self.verKey(acc_id, content_uuid)) or 0)
+        except redis.RedisError:
+            return 'local'
+
+    def get_doc(self, acc_id, version, content_uuid):
+        if version is None:
+            return None
+        key = self.docKey(acc_id, version, content_uuid)
+        try:
+            raw = self.redis.get(key)
+            return json.loads(raw) if raw else None
+        except redis.RedisError:
+            return self.local.get(key)
+
+    def set_doc(self, acc_id, version, content_uuid, value):
+        if version is None:
+            return
+        key = self.docKey(acc_id, version, content_uuid)
+        try:
+            self.redis.set(key, json.dumps(value), ex=self.ttl)
+        except redis.RedisError:
+            self.local.set(key, value)
+
+    def get_listing(self, acc_id, generation, query):
+        if generation is None:
+            return None
+        key = self.listKey(acc_id, generation)
+        try:
+            raw = self.redis.hget(key, query)
+            return json.loads(raw) if raw else None
+        except redis.RedisError:
+            return (self.local.get(key) or {}).get(query)
+
+    def set_listing(self, acc_id, generation, query, value):
+        if generation is None:
+            return
+        key = self.listKey(acc_id, generation)
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hset(key, query, json.dumps(value))
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        except redis.RedisError:
+            listings = dict(self.local.get(key) or {}, **{query: value})
+            self.local.set(key, listings)
+
+    def bump(self, acc_id, content_uuids):
+        pipe = self.redis.pipeline()
+        pipe.incr(self.genKey(acc_id))
+        for content_uuid in content_uuids:
+            # outlive any entry filled under the previous version
+            pipe.incr(self.verKey(acc_id, content_uuid))
+            pipe.expire(self.verKey(acc_id, content_uuid), self.ttl * 2)
+        pipe.execute()
+
+    def stale(self, acc_id):
+        content_uuids = self.pending.get(acc_id)
+        if content_uuids is None:
+            return False
+        try:
+            self.bump(acc_id, content_uuids)
+        except redis.RedisError:
+            return True
+        self.pending.pop(acc_id, None)
+        return False
+
+    def invalidate(self, acc_id, content_uuids):
+        self.local_generations[acc_id] = self.local_generations.get(acc_id, 0) + 1
+        for content_uuid in content_uuids:
+            self.local.discard(self.docKey(acc_id, 'local', content_uuid))
+
+        content_uuids = set(content_uuids) | self.pending.pop(acc_id, set())
+        try:
+            self.bump(acc_id, content_uuids)
+        except redis.RedisError as e:
+            self.pending[acc_id] = content_uuids
+            errorLog.error(
+                f"content cache invalidate failed, bypass until retried, account_id={acc_id}, error={e}")
+
+
+def invalidate(acc_id, content_uuids):
+    cache = current_app.extensions.get('content_cache')
+    if cache is not None:
+        cache.invalidate(acc_id, content_uuids)
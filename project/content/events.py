@@ -0,0 +1,124 @@
+import json
+import time
+import random
+import queue
+import logging
+from threading import Lock, Thread
+from collections import defaultdict
+
+import redis
+from flask import current_app
+
+appLog = logging.getLogger("server.app")
+errorLog = logging.getLogger("server.error")
+
+CHANNEL_PREFIX = 'content-events'
+LISTEN_DELAY = 1
+LISTEN_MAX_DELAY = 60
+
+
+def channel(acc_id):
+    return f'{CHANNEL_PREFIX}:{acc_id}'
+
+
+def status_event(content):
+    return {
+        'content_id': content.uuid,
+        'status': content.status,
+        'total_records': content.total_records,
+        'success_records': content.success_records,
+        'error_records': content.error_records
+    }
+
+
+def publish(acc_id, events):
+    try:
+        conn = redis.Redis(connection_pool=current_app.extensions['redis_pool'])
+        pipe = conn.pipeline(transaction=False)
+        for event in events:
+            pipe.publish(channel(acc_id), json.dumps(event))
+        pipe.execute()
+    except redis.RedisError as e:
+        errorLog.error(
+            f"content events publish failed, account_id={acc_id}, error={e}")
+
+
+class EventHub:
+    """Fans Redis status events out to SSE streams of this process.
+
+    Every open stream holds a server thread, so at most `max_streams` are
+    served per process; subscribe returns None above the cap.
+    """
+
+    def __init__(self, conn_url, queue_size, max_streams):
+        self.conn_url = conn_url
+        self.queue_size = queue_size
+        self.max_streams = max_streams
+        self.subscribers = defaultdict(set)
+        self.streams = 0
+        self.lock = Lock()
+        self.thread = None
+
+    def subscribe(self, acc_id):
+        events = queue.Queue(self.queue_size)
+        with self.lock:
+            if self.streams >= self.max_streams:
+                errorLog.error(f"content events stream limit reached, account_id={acc_id}")
+                return None
+            self.subscribers[str(acc_id)].add(events)
+            self.streams += 1
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.listen, daemon=True)
+                self.thread.start()
+        return events
+
+    def unsubscribe(self, acc_id, events):
+        with self.lock:
+            subscribers = self.subscribers.get(str(acc_id))
+            if subscribers is not None and events in subscribers:
+                subscribers.discard(events)
+                self.streams -= 1
+                if not subscribers:
+                    del self.subscribers[str(acc_id)]
+
+    def dispatch(self, acc_id, data):
+        with self.lock:
+            subscribers = list(self.subscribers.get(acc_id, ()))
+        for events in subscribers:
+            try:
+                events.put_nowait(data)
+            except queue.Full:
+                errorLog.error(f"content events dropped, account_id={acc_id}")
+
+    def listen(self):
+        attempt = 0
+        while True:
+            conn = redis.Redis.from_url(self.conn_url)
+            pubsub = conn.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe(f'{CHANNEL_PREFIX}:*')
+                appLog.info("content events listener subscribed")
+                attempt = 0
+                for message in pubsub.listen():
+                    acc_id = message['channel'].decode().rsplit(':', 1)[1]
+                    self.dispatch(acc_id, message['data'].decode())
+            except Exception as e:
+                errorLog.exception(f"content events listener failed, attempt={attempt + 1}, error={e}")
+            finally:
+                pubsub.close()
+                conn.connection_pool.disconnect()
+
+            # full jitter keeps every worker from resubscribing at once
+            time.sleep(random.uniform(0, min(LISTEN_MAX_DELAY, LISTEN_DELAY * 2 ** attempt)))
+            attempt += 1
+
+    def stream(self, events, timeout, heartbeat):
+        yield f'retry: {heartbeat * 1000}\n\n'
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                data = events.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+                continue
+            yield f'event: status\ndata: {data}\n\n'
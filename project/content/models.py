@@ -3,12 +3,16 @@ import logging
 from traceback import format_exception_only as format_exc
 from datetime import datetime
 
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import func, text, or_
+from sqlalchemy.dialects.postgresql import UUID, insert
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 
 from project import db
 from project.account.models import Account
 from project.Exceptions import EntityNotFoundError
+from project.utils import Status
+from .cache import invalidate
+from .events import publish, status_event
 
 
 error_log = logging.getLogger("server.error")
@@ -17,6 +21,18 @@ app_log = logging.getLogger("server.app")
 
 class Content(db.Model):
     __tablename__ = 'content'
+    __table_args__ = (
+        db.Index('ix_content_account_id_id', 'account_id', 'id',
+                 postgresql_where=text('deleted = false')),
+        db.Index('ix_content_account_id_status', 'account_id', 'status',
+                 postgresql_where=text('deleted = false')),
+        db.Index('ix_content_account_id_filename', 'account_id', 'filename',
+                 postgresql_where=text('deleted = false')),
+        db.Index('ix_content_account_id_filename_trgm', 'account_id', 'filename',
+                 postgresql_using='gin',
+                 postgresql_ops={'filename': 'gin_trgm_ops'},
+                 postgresql_where=text('deleted = false')),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     uuid = db.Column(db.String, unique=True,
@@ -31,6 +47,10 @@ class Content(db.Model):
     error_records = db.Column(db.Integer)
     deleted = db.Column(db.Boolean, default=False)
     path_file = db.Column(db.String)
+    codec = db.Column(db.String)
+    file_size = db.Column(db.BigInteger)
+    stored_size = db.Column(db.BigInteger)
+    digest = db.Column(db.String(64), index=True)
 
     created_at = db.Column(db.Date)
     upload_at = db.Column(db.DateTime)
@@ -42,6 +62,7 @@ class Content(db.Model):
         try:
             db.session.add(self)
             db.session.commit()
+            invalidate(self.account_id, [self.uuid])
             app_log.info(
                 f"create content, content_id={self.id}, content_uuid={self.uuid}")
         except SQLAlchemyError as e:
@@ -50,8 +71,10 @@ class Content(db.Model):
             raise
 
     def commit(self):
+        acc_id, content_uuid = self.account_id, self.uuid
         try:
             db.session.commit()
+            invalidate(acc_id, [content_uuid])
             app_log.info(
                 f"content update, content_id={self.id}, content_uuid={self.uuid}")
         except SQLAlchemyError as e:
@@ -59,10 +82,30 @@ class Content(db.Model):
             error_log.error(format_exc(type(e), e))
             raise
 
+    @classmethod
+    def save_all(cls, contents, before_commit=None):
+        try:
+            db.session.add_all(contents)
+            db.session.flush()
+            if before_commit:
+                before_commit(contents)
+            keys = [(content.account_id, content.uuid) for content in contents]
+            db.session.commit()
+            for acc_id in {key[0] for key in keys}:
+                invalidate(acc_id, [key[1] for key in keys if key[0] == acc_id])
+            app_log.info(
+                f"create contents, content_ids={[content.id for content in contents]}")
+        except Exception as e:
+            db.session.rollback()
+            error_log.error(format_exc(type(e), e))
+            raise
+
     def delete(self):
+        acc_id, content_uuid = self.account_id, self.uuid
         try:
             db.session.delete(self)
             db.session.commit()
+            invalidate(acc_id, [content_uuid])
             app_log.info(
                 f"content delete, content_id={self.id}, content_uuid={self.uuid}")
         except SQLAlchemyError as e:
@@ -71,10 +114,24 @@ class Content(db.Model):
             raise
 
     @classmethod
-    def get_all(cls, acc_id):
+    def paginate(cls, query, limit=None, cursor=None, columns=None):
+        if columns:
+            query = query.with_entities(
+                *(getattr(cls, column) for column in columns))
+        if cursor is not None:
+            query = query.filter(cls.id > cursor)
+        query = query.order_by(cls.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def get_all(cls, acc_id, limit=None, cursor=None, columns=None):
+        result_query = cls.query.filter_by(account_id=acc_id, deleted=False)
+        result_query = cls.paginate(result_query, limit, cursor, columns)
+
         try:
-            contents = cls.query\
-                .filter_by(account_id=acc_id, deleted=False).all()
+            contents = result_query.all()
         except SQLAlchemyError as e:
             error_log.error(format_exc(type(e), e))
             raise
@@ -124,15 +181,16 @@ class Content(db.Model):
             raise e
 
     @classmethod
-    def find_by_filename(cls, acc_id, filename, filename_op=None):
+    def find_by_filename(cls, acc_id, filename, filename_op=None,
+                         limit=None, cursor=None, columns=None):
         result_query = cls.query.filter(
             Content.account_id == acc_id, Content.deleted == False)
         if filename_op == 'like':
-            print('in like')
             result_query = result_query\
                 .filter(Content.filename.like(f'%{filename}%'))
         else:
             result_query = result_query.filter(Content.filename == filename)
+        result_query = cls.paginate(result_query, limit, cursor, columns)
 
         try:
             content = result_query.all()
@@ -149,18 +207,195 @@ class Content(db.Model):
             raise e
 
     @classmethod
-    def count_or_count_by_status(cls, acc_id, status=None):
-        result_query = cls.query.filter_by(account_id=acc_id, deleted=False)
+    def search(cls, acc_id, q, status=None, created_from=None, created_to=None,
+               limit=None, offset=None, columns=None):
+        pattern = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        exact = cls.filename.ilike(pattern, escape='\\')
+        prefix = cls.filename.ilike(f'{pattern}%', escape='\\')
+        substring = cls.filename.ilike(f'%{pattern}%', escape='\\')
+        similar = cls.filename.op('%>')(q)
+
+        result_query = cls.query.filter(
+            cls.account_id == acc_id, cls.deleted == False, or_(substring, similar))
         if status:
-            result_query = result_query.filter_by(status=status)
+            result_query = result_query.filter(cls.status == status)
+        if created_from:
+            result_query = result_query.filter(cls.created_at >= created_from)
+        if created_to:
+            result_query = result_query.filter(cls.created_at <= created_to)
+        if columns:
+            result_query = result_query.with_entities(
+                *(getattr(cls, column) for column in columns))
+
+        result_query = result_query.order_by(
+            exact.desc(), prefix.desc(), substring.desc(),
+            func.word_similarity(q, cls.filename).desc(), cls.id)
+        if offset:
+            result_query = result_query.offset(offset)
+        if limit is not None:
+            result_query = result_query.limit(limit)
 
         try:
-            count = result_query.count()
+            contents = result_query.all()
         except SQLAlchemyError as e:
             error_log.error(format_exc(type(e), e))
             raise
 
-        return count if count else 0
+        if contents:
+            return contents
+        else:
+            e = EntityNotFoundError(
+                f"content not found by q={q}, account_id={acc_id}")
+            error_log.error(format_exc(type(e), e))
+            raise e
+
+    @classmethod
+    def find_processed(cls, acc_id, digest):
+        try:
+            return cls.query\
+                .filter(cls.account_id == acc_id, cls.digest == digest,
+                        cls.status == Status.SUCCESS.value, cls.deleted == False)\
+                .order_by(cls.id.desc())\
+                .first()
+        except SQLAlchemyError as e:
+            error_log.error(format_exc(type(e), e))
+            raise
+
+    @classmethod
+    def update_statuses(cls, results):
+        values, params = [], {'modified_at': datetime.now()}
+        for i, result in enumerate(results):
+            values.append(f"""(CAST(:account_id_{i} AS INTEGER), CAST(:content_id_{i} AS INTEGER),
+                CAST(:status_{i} AS VARCHAR), CAST(:total_records_{i} AS INTEGER),
+                CAST(:success_records_{i} AS INTEGER), CAST(:error_records_{i} AS INTEGER))""")
+            for key in ('account_id', 'content_id', 'status', 'total_records',
+                        'success_records', 'error_records'):
+                params[f'{key}_{i}'] = result.get(key)
+
+        statement = text(f"""
+            UPDATE content AS c
+            SET status = v.status,
+                total_records = v.total_records,
+                success_records = v.success_records,
+                error_records = v.error_records,
+                modified_at = :modified_at
+            FROM (VALUES {', '.join(values)})
+                AS v(account_id, content_id, status, total_records,
+                     success_records, error_records)
+            WHERE c.id = v.content_id AND c.account_id = v.account_id
+            RETURNING c.id, c.account_id, c.uuid, c.status, c.total_records,
+                c.success_records, c.error_records""")
+
+        try:
+            rows = db.session.execute(statement, params).fetchall()
+            db.session.commit()
+            updated = [row.id for row in rows]
+            for acc_id in {row.account_id for row in rows}:
+                account_rows = [row for row in rows if row.account_id == acc_id]
+                invalidate(acc_id, [row.uuid for row in account_rows])
+                publish(acc_id, [status_event(row) for row in account_rows])
+            app_log.info(f"content status update, content_ids={updated}")
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            error_log.error(format_exc(type(e), e))
+            raise
+
+        return updated
+
+    @classmethod
+    def count_by_status(cls, acc_id):
+        result_query = db.session.query(cls.status, func.count(cls.id))\
+            .filter(cls.account_id == acc_id, cls.deleted == False)\
+            .group_by(cls.status)
+
+        try:
+            rows = result_query.all()
+        except SQLAlchemyError as e:
+            error_log.error(format_exc(type(e), e))
+            raise
+
+        return {status: count for status, count in rows}
 
     def __repr__(self):
         return f'<Content filename={self.filename}>'
+
+
+class Blob(db.Model):
+    __tablename__ = 'blob'
+
+    filename_fs = db.Column(db.String, primary_key=True)
+    digest = db.Column(db.String(64), nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def acquire(cls, filename_fs, digest):
+        statement = insert(cls.__table__)\
+            .values(filename_fs=filename_fs, digest=digest, ref_count=1)
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.filename_fs],
+            set_={'ref_count': cls.__table__.c.ref_count + 1})
+
+        try:
+            db.session.execute(statement)
+        except SQLAlchemyError as e:
+            error_log.error(format_exc(type(e), e))
+            raise
+
+    @classmethod
+    def release(cls, filename_fs):
+        try:
+            cls.query.filter_by(filename_fs=filename_fs)\
+                .update({cls.ref_count: cls.ref_count - 1},
+                        synchronize_session=False)
+        except SQLAlchemyError as e:
+            error_log.error(format_exc(type(e), e))
+            raise
+
+    @classmethod
+    def referenced(cls, filenames):
+        try:
+            return {row.filename_fs for row in
+                    cls.query.filter(cls.filename_fs.in_(filenames), cls.ref_count > 0).all()}
+        except SQLAlchemyError as e:
+            error_log.error(format_exc(type(e), e))
+            raise
+
+    @classmethod
+    def unreferenced(cls, limit):
+        try:
+            return [row.filename_fs for row in
+                    cls.query.filter(cls.ref_count <= 0).limit(limit).all()]
+        except SQLAlchemyError as e:
+            error_log.error(format_exc(type(e), e))
+            raise
+
+    @classmethod
+    def lock_unreferenced(cls, filename_fs):
+        """Row-lock the blob if nothing references it; a concurrent acquire
+        waits for the caller's commit."""
+        try:
+            return cls.query\
+                .filter(cls.filename_fs == filename_fs, cls.ref_count <= 0)\
+                .with_for_update()\
+                .first() is not None
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            error_log.error(format_exc(type(e), e))
+            raise
+
+    @classmethod
+    def delete_unreferenced(cls, filenames):
+        try:
+            deleted = cls.query\
+                .filter(cls.filename_fs.in_(filenames), cls.ref_count <= 0)\
+                .delete(synchronize_session=False)
+            db.session.commit()
+            app_log.info(f"blobs delete, count={deleted}")
+            return deleted
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            error_log.error(format_exc(type(e), e))
+            raise
+
+    def __repr__(self):
+        return f'<Blob filename_fs={self.filename_fs} ref_count={self.ref_count}>'
@@ -14,6 +14,8 @@ class ContentSchema(Schema):
     error_records = fields.Int()
     created_at = fields.Date(required=True)
     upload_at = fields.DateTime()
+    file_size = fields.Int(dump_only=True)
+    digest = fields.Str(dump_only=True)
 
     ordered = True
 
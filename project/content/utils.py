@@ -1,79 +1,453 @@
 import os
+import gzip
+import base64
 import json
+import fcntl
+import hashlib
+import time
 import uuid
 import logging
+import socket
 import redis
+import tempfile
+from collections import namedtuple
+from contextlib import closing, contextmanager
 from traceback import format_exception_only as format_exc
 
-from flask import g
-from werkzeug.datastructures import FileStorage
+from flask import g, current_app
 from werkzeug.utils import secure_filename
 
-from project import config
+from project.Exceptions import UploadNotFoundError, UploadOffsetError, DigestMismatchError
+from project.utils import Status
+from project.storage import shardKey
+from project import db
+from .models import Content, Blob
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 app_log = logging.getLogger("server.app")
 error_log = logging.getLogger("error.log")
 
+CHUNK_SIZE = 64 * 1024
+CODEC_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+DIGEST_ALGORITHMS = {'sha-256': 'sha256', 'md5': 'md5'}
+
+SavedFile = namedtuple('SavedFile', ['path', 'filename_fs', 'size', 'stored_size', 'digest',
+                                     'created'])
+
+BLOB_FOLDER = 'objects'
+
 
 def get_uuid():
     return str(uuid.uuid4())[-10:]
 
 
-def readFile(path):
+def sendFile(storage, key, mimetype='application/xml'):
     try:
-        with open(path) as f:
-            return f.read()
+        return storage.send(key, mimetype)
     except Exception as e:
         error_log.error(format_exc(type(e), e))
         raise
 
 
-def saveFile(stream, filename, path_conf):
+def compressWriter(f, codec):
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='wb')
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().stream_writer(f)
+    raise ValueError(f'unsupported codec={codec}')
+
+
+def decompressReader(f, codec):
+    if codec == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    raise ValueError(f'unsupported codec={codec}')
+
+
+def requestDigests(headers):
+    expected = {}
+    for item in headers.get('Content-Digest', '').split(','):
+        name, sep, value = item.strip().partition('=')
+        algorithm = DIGEST_ALGORITHMS.get(name.lower())
+        if algorithm and sep:
+            expected[algorithm] = base64.b64decode(value.strip(':'), validate=True)
+    if 'Content-MD5' in headers:
+        expected['md5'] = base64.b64decode(headers['Content-MD5'], validate=True)
+    return expected
+
+
+class DigestReader:
+    def __init__(self, stream, expected):
+        self.stream = stream
+        self.expected = expected
+        self.digests = {name: hashlib.new(name) for name in expected}
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        for digest in self.digests.values():
+            digest.update(chunk)
+        return chunk
+
+    def verify(self):
+        mismatched = [name for name, value in self.expected.items()
+                      if self.digests[name].digest() != value]
+        if mismatched:
+            raise DigestMismatchError(mismatched)
+
+
+def requestStream(request, source=None):
+    source = source or request.stream
+    encoding = request.headers.get('Content-Encoding', 'identity')
+    if encoding == 'identity':
+        return source
+    return decompressReader(source, encoding)
+
+
+def copyStream(src, dst, digest=None):
+    size = 0
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            return size
+        dst.write(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        size += len(chunk)
+
+
+def streamFile(storage, key, codec=None):
+    with closing(storage.open(key)) as f:
+        reader = decompressReader(f, codec) if codec else f
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def fsKey(filename, codec=None):
     random_seq = str(uuid.uuid4())[:8]
 
+    filename, file_extension = os.path.splitext(secure_filename(filename))
+    codec_extension = CODEC_EXTENSIONS.get(codec, '')
+    return shardKey(f'{filename}---{random_seq}{file_extension}{codec_extension}')
+
+
+def blobKey(digest, codec=None):
+    codec_extension = CODEC_EXTENSIONS.get(codec, '')
+    return os.path.join(
+        BLOB_FOLDER, digest[:2], digest[2:4], f'{digest}{codec_extension}')
+
+
+def storeBlob(path, digest, storage, codec=None):
+    key = blobKey(digest, codec)
+
+    try:
+        # touching the blob keeps it out of a concurrent purge
+        storage.touch(key)
+        os.remove(path)
+        app_log.info(f'file dedup hit, filenameFs={key}')
+        return key, False
+    except FileNotFoundError:
+        storage.put(path, key)
+        return key, True
+
+
+def saveFile(stream, filename, storage, codec=None, dedup=False, verify=None):
     full_filename = secure_filename(filename)
-    filename, file_extension = os.path.splitext(full_filename)
-    filenameFs = f'{filename}---{random_seq}{file_extension}'
-    pathFile = os.path.join(path_conf, filenameFs)
-    absPath = os.path.abspath(pathFile)
+    digest = hashlib.sha256()
+    spoolPath = None
 
     try:
-        FileStorage(stream).save(absPath)
+        with tempfile.NamedTemporaryFile(dir=storage.spool, suffix='.tmp',
+                                         delete=False) as f:
+            spoolPath = f.name
+            out = compressWriter(f, codec) if codec else f
+            size = copyStream(stream, out, digest)
+            if out is not f:
+                out.close()
+        stored_size = os.path.getsize(spoolPath)
+        if verify:
+            verify()
+
+        if dedup:
+            filenameFs, created = storeBlob(spoolPath, digest.hexdigest(), storage, codec)
+        else:
+            filenameFs, created = fsKey(filename, codec), True
+            storage.put(spoolPath, filenameFs)
         app_log.info(
-            f'file success save, filename={full_filename}, filenameFs={filenameFs}')
-        return absPath, filenameFs
+            f'file success save, filename={full_filename}, filenameFs={filenameFs}, size={size}, stored_size={stored_size}')
+        return SavedFile(storage.uri(filenameFs), filenameFs, size, stored_size,
+                         digest.hexdigest(), created)
     except Exception as e:
+        if spoolPath and os.path.isfile(spoolPath):
+            os.remove(spoolPath)
         error_log.error(format_exc(type(e), e))
         raise
 
 
-def get_redis():
-    app_config = os.getenv('APP_CONFIG', 'project.config.DevConfig')
-    config_class = getattr(config, app_config.split('.')[-1])
+def stagingPath(path_conf, content_uuid):
+    return os.path.abspath(os.path.join(path_conf, f'{content_uuid}.part'))
 
-    if 'redis' not in g:
-        g.redis_db = redis.Redis.from_url(config_class.REDIS_CONN_URL)
-        g.redis_db.ping()
-        app_log.info("connect to redis success")
-    return g.redis_db
 
+def stagingOffset(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        raise UploadNotFoundError(f'upload not initiated, path={path}')
 
-def enqueue(content):
-    app_config = os.getenv('APP_CONFIG', 'project.config.DevConfig')
-    config_class = getattr(config, app_config.split('.')[-1])
 
-    data = {
+@contextmanager
+def lockStaging(path, mode='r+b'):
+    try:
+        f = open(path, mode)
+    except FileNotFoundError:
+        raise UploadNotFoundError(f'upload not initiated, path={path}')
+
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # the file may have been finalized while we waited for the lock
+        try:
+            moved = os.fstat(f.fileno()).st_ino != os.stat(path).st_ino
+        except FileNotFoundError:
+            moved = True
+        if moved:
+            raise UploadNotFoundError(f'upload not initiated, path={path}')
+        yield f
+
+
+def purgeStaging(folder, maxAge):
+    """Remove staging files no chunk or finalize has touched for maxAge seconds.
+
+    Uploads that hold the staging lock are skipped; one that was waiting
+    for it finds the file gone and gets upload_not_initiated.
+    """
+    cutoff = time.time() - maxAge
+    removed = 0
+    for entry in os.scandir(folder):
+        if not entry.name.endswith('.part') or not entry.is_file():
+            continue
+        try:
+            if entry.stat().st_mtime > cutoff:
+                continue
+            with open(entry.path, 'r+b') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                stat = os.fstat(f.fileno())
+                if stat.st_ino != os.stat(entry.path).st_ino or stat.st_mtime > cutoff:
+                    continue
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            continue
+    app_log.info(f'staging files purged, count={removed}')
+    return removed
+
+
+def appendChunk(path, stream, offset, verify=None):
+    with lockStaging(path) as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() != offset:
+            raise UploadOffsetError(f.tell())
+        size = copyStream(stream, f)
+        if verify:
+            try:
+                verify()
+            except DigestMismatchError:
+                f.truncate(offset)
+                raise
+        return offset + size
+
+
+def fileDigest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def promoteFile(path, filename, storage, codec=None, dedup=False, digest=None):
+    try:
+        if codec:
+            with open(path, 'rb') as f:
+                saved = saveFile(f, filename, storage, codec, dedup)
+            os.remove(path)
+            return saved
+
+        digest = digest or fileDigest(path)
+        size = os.path.getsize(path)
+        if dedup:
+            filenameFs, created = storeBlob(path, digest, storage)
+        else:
+            filenameFs, created = fsKey(filename), True
+            storage.put(path, filenameFs)
+        app_log.info(
+            f'file success promote, filename={filename}, filenameFs={filenameFs}, size={size}')
+        return SavedFile(storage.uri(filenameFs), filenameFs, size, size, digest, created)
+    except Exception as e:
+        error_log.error(format_exc(type(e), e))
+        raise
+
+
+def purgeBlobs(filenames, storage, grace):
+    """Remove unreferenced blobs, each under its row lock.
+
+    A dedup hit touches the blob and then acquires it; the lock holds that
+    acquire back until the file and its row are gone, and attach_file checks
+    the blob still exists once it holds the reference.
+    """
+    purged = 0
+    for filenameFs in filenames:
+        if not Blob.lock_unreferenced(filenameFs):
+            db.session.rollback()
+            continue
+        try:
+            if time.time() - storage.mtime(filenameFs) < grace:
+                db.session.rollback()
+                continue
+            storage.delete(filenameFs)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            db.session.rollback()
+            raise
+        purged += Blob.delete_unreferenced([filenameFs])
+    app_log.info(f'blobs purged, count={purged}')
+    return purged
+
+
+def get_storage():
+    return current_app.extensions['storage']
+
+
+def get_redis():
+    if 'redis_db' not in g:
+        g.redis_db = redis.Redis(
+            connection_pool=current_app.extensions['redis_pool'])
+    return g.redis_db
+
+
+def taskData(content):
+    return {
         'account_id': content.account_id,
         'content_id': content.id,
         'content_uuid': content.uuid,
-        'file': content.filename_fs
+        'file': content.filename_fs,
+        'codec': content.codec,
+        'digest': content.digest
     }
 
+
+def enqueue(content):
+    data = taskData(content)
+
     try:
         conn = get_redis()
-        conn.rpush(config_class.REDIS_QUEUE, json.dumps(data))
+        conn.lpush(current_app.config['REDIS_QUEUE'], json.dumps(data))
         app_log.info(f'task enqueue in redis queue, data={data}')
     except redis.RedisError as e:
         error_log.critical(
             f"error connect to redis, error={format_exc(type(e), e)}")
         raise
+
+
+def enqueue_many(contents):
+    if not contents:
+        return
+
+    tasks = [json.dumps(taskData(content)) for content in contents]
+
+    try:
+        conn = get_redis()
+        conn.lpush(current_app.config['REDIS_QUEUE'], *tasks)
+        app_log.info(
+            f'tasks enqueue in redis queue, content_ids={[c.id for c in contents]}')
+    except redis.RedisError as e:
+        error_log.critical(
+            f"error connect to redis, error={format_exc(type(e), e)}")
+        raise
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_valid_result(result):
+    return isinstance(result, dict) \
+        and is_int(result.get('account_id')) and is_int(result.get('content_id')) \
+        and result.get('status') in (Status.SUCCESS.value, Status.ERROR.value) \
+        and all(result.get(key) is None or is_int(result[key])
+                for key in ('total_records', 'success_records', 'error_records'))
+
+
+def parse_result(raw):
+    try:
+        result = json.loads(raw)
+    except ValueError:
+        return None
+    return result if is_valid_result(result) else None
+
+
+def pop_results(conn, queue, processing, batch_size, timeout):
+    first = conn.brpoplpush(queue, processing, timeout)
+    if first is None:
+        return []
+
+    pipe = conn.pipeline(transaction=False)
+    for _ in range(batch_size - 1):
+        pipe.rpoplpush(queue, processing)
+    return [first] + [raw for raw in pipe.execute() if raw is not None]
+
+
+def apply_results(batch_size=500, timeout=5, once=False, consumer=None):
+    """Apply robot results from RESULTS_QUEUE in batches.
+
+    Each consumer owns `<queue>:processing:<consumer>`, so the consumer name
+    must be unique among running consumers and stable across restarts for
+    its leftovers to be re-applied. Entries that are not valid results are
+    moved to `<queue>:dead` instead of blocking the batch.
+    """
+    conn = get_redis()
+    queue = current_app.config['RESULTS_QUEUE']
+    consumer = consumer or socket.gethostname()
+    processing = f'{queue}:processing:{consumer}'
+    dead = f'{queue}:dead'
+
+    pending = conn.lrange(processing, 0, -1)
+    if pending:
+        app_log.info(f'results recovered from processing list, count={len(pending)}')
+
+    applied = 0
+    while True:
+        raw_results = pending or pop_results(conn, queue, processing,
+                                             batch_size, timeout)
+        pending = None
+
+        if raw_results:
+            valid, invalid = [], []
+            for raw in raw_results:
+                result = parse_result(raw)
+                if result is None:
+                    invalid.append(raw)
+                else:
+                    valid.append(result)
+
+            if invalid:
+                error_log.error(
+                    f'malformed results moved to {dead}, count={len(invalid)}')
+                conn.rpush(dead, *invalid)
+            if valid:
+                Content.update_statuses(valid)
+            conn.delete(processing)
+            applied += len(valid)
+
+        if once:
+            return applied
@@ -1,15 +1,23 @@
+import os
+import json
 import logging
-from datetime import datetime
+from datetime import date, datetime
 from traceback import format_exception_only as format_exc
 
-from flask import Blueprint, g, request, jsonify, make_response, current_app
+from flask import Blueprint, g, request, jsonify, make_response, current_app, Response
 from flask_restful import Api, Resource
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import quote_etag
 
-from .models import Content
+from project import db
+from .models import Content, Blob
 from .schemas import ContentSchema
+from .cache import queryHash, bodyEtag
+from .events import publish, status_event
 from project.content.utils import *
 from project.utils import is_json, token_required, Status
-from project.Exceptions import EntityNotFoundError
+from project.Exceptions import EntityNotFoundError, UploadNotFoundError, UploadOffsetError,\
+    DigestMismatchError
 
 
 bp = Blueprint('content', __name__, url_prefix='/api')
@@ -17,27 +25,175 @@ api = Api(bp)
 app_log = logging.getLogger("server.app")
 
 
+def attach_file(content, saved, codec):
+    content.path_file, content.filename_fs = saved.path, saved.filename_fs
+    content.codec = codec
+    content.file_size, content.stored_size = saved.size, saved.stored_size
+    content.digest = saved.digest
+    if current_app.config['STORAGE_DEDUP']:
+        Blob.acquire(saved.filename_fs, saved.digest)
+        if not saved.created:
+            # a purge that raced the dedup hit has released its row lock by
+            # now; the blob must have survived it
+            get_storage().mtime(saved.filename_fs)
+
+
+def discard_files(keys, storage, dedup):
+    """Remove files this request stored before it failed.
+
+    A blob created here may already be shared by a concurrent upload that
+    hit it by digest, so with dedup only blobs nobody references are removed.
+    """
+    db.session.rollback()
+    if dedup and keys:
+        try:
+            keys = set(keys) - Blob.referenced(keys)
+        except Exception:
+            return
+    for key in keys:
+        storage.delete(key)
+
+
+def reuse_result(content):
+    if not current_app.config['STORAGE_DEDUP']:
+        return False
+
+    processed = Content.find_processed(content.account_id, content.digest)
+    if processed is None:
+        return False
+
+    content.status = processed.status
+    content.total_records = processed.total_records
+    content.success_records = processed.success_records
+    content.error_records = processed.error_records
+    app_log.info(
+        f"processing skipped, content_id={content.id}, reused_content_id={processed.id}")
+    return True
+
+
+def complete_upload(content, saved, codec):
+    attach_file(content, saved, codec)
+
+    reused = reuse_result(content)
+    if not reused:
+        enqueue(content)
+        content.status = Status.PROCESSING.value
+    content.upload_at = datetime.now()
+    content.commit()
+    if reused:
+        publish(content.account_id, [status_event(content)])
+
+    app_log.info(
+        f"""file_upload, content_id={content.id},
+        fname={content.filename}, fname_in_fs={content.filename_fs}""")
+
+
+def content_etag(content):
+    modified_at = content.modified_at.timestamp() if content.modified_at else 0
+    return f'{content.id}-{int(modified_at * 1000000)}'
+
+
+def cached_response(cached):
+    headers = {'ETag': quote_etag(cached['etag'])}
+    if request.if_none_match.contains(cached['etag']):
+        return {}, 304, headers
+    return cached['body'], 200, headers
+
+
+def search_filters(args):
+    status = args.get('status', None)
+    if status and status not in {s.value for s in Status}:
+        raise ValueError(f'unknown status={status}')
+
+    created_from, created_to = (
+        datetime.strptime(args[name], '%Y-%m-%d').date() if args.get(name) else None
+        for name in ('created_from', 'created_to'))
+    return status, created_from, created_to
+
+
+CONTENT_FIELDS = ContentSchema().fields
+
+
+def content_columns(fields):
+    columns = ['id', 'uuid']
+    for name in fields:
+        field = CONTENT_FIELDS[name]
+        columns.append(field.attribute or name)
+    return columns
+
+
 @api.resource('/contents')
 class Contents(Resource):
     method_decorators = [token_required()]
 
     def get(self):
+        acc_id = g.payload['account_id']
+        cache = current_app.extensions['content_cache']
+        query = queryHash(request.args)
+        generation = cache.generation(acc_id)
+        cached = cache.get_listing(acc_id, generation, query)
+        if cached is not None:
+            return cached_response(cached)
+
+        q = request.args.get('q', None)
         filename = request.args.get('filename', None)
         filename_op = request.args.get('op', None)
+        cursor = request.args.get('cursor', None)
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = request.args.get('limit',
+                                 current_app.config['CONTENTS_PAGE_LIMIT'],
+                                 type=int)
+        limit = max(1, min(limit, current_app.config['CONTENTS_MAX_PAGE_LIMIT']))
+        fields = request.args.get('fields', None)
+
+        if cursor is not None:
+            try:
+                cursor = int(cursor)
+            except ValueError:
+                return {'error': 'malformed_request'}, 400
+
+        columns = None
+        if fields:
+            fields = tuple(fields.split(','))
+            try:
+                columns = content_columns(fields)
+            except KeyError:
+                return {'error': 'malformed_request'}, 400
+
+        try:
+            status, created_from, created_to = search_filters(request.args)
+        except ValueError:
+            return {'error': 'malformed_request'}, 400
 
         try:
-            if filename:
+            if q:
+                contents = Content.search(
+                    acc_id, q, status, created_from, created_to,
+                    limit + 1, offset, columns)
+            elif filename:
                 contents = Content.find_by_filename(
-                    g.payload['account_id'], filename, filename_op)
+                    g.payload['account_id'], filename, filename_op,
+                    limit + 1, cursor, columns)
             else:
-                contents = Content.get_all(g.payload['account_id'])
+                contents = Content.get_all(
+                    g.payload['account_id'], limit + 1, cursor, columns)
         except EntityNotFoundError:
             return {}, 404
         except Exception:
             return {}, 500
 
+        links = {}
+        if len(contents) > limit:
+            contents = contents[:limit]
+            args = request.args.to_dict()
+            if q:
+                args.update(offset=offset + limit, limit=limit)
+            else:
+                args.update(cursor=contents[-1].id, limit=limit)
+            links['next'] = api.url_for(Contents, **args)
+
         objects = []
-        schema = ContentSchema(exclude=('content_id'))
+        schema = ContentSchema(only=fields, exclude=('content_id'))
         for content in contents:
             obj = {
                 'content_id': content.uuid,
@@ -49,22 +205,26 @@ class Contents(Resource):
             }
             objects.append(obj)
 
-        acc_id = g.payload['account_id']
         try:
+            counts = Content.count_by_status(acc_id)
             responsObj = {
-                'total_contents': Content.count_or_count_by_status(acc_id),
-                'success_status': Content.count_or_count_by_status(acc_id, 'success'),
-                'error_status': Content.count_or_count_by_status(acc_id, 'error'),
-                'process_status': Content.count_or_count_by_status(acc_id, 'processing'),
-                'uploading_status': Content.count_or_count_by_status(acc_id, 'uploading'),
-                'objects': objects
+                'total_contents': sum(counts.values()),
+                'success_status': counts.get(Status.SUCCESS.value, 0),
+                'error_status': counts.get(Status.ERROR.value, 0),
+                'process_status': counts.get(Status.PROCESSING.value, 0),
+                'uploading_status': counts.get(Status.UPLOADING.value, 0),
+                'objects': objects,
+                'links': links
             }
-            return responsObj
         except EntityNotFoundError:
             return {}, 404
         except Exception as e:
             return {}, 500
 
+        cached = {'etag': bodyEtag(responsObj), 'body': responsObj}
+        cache.set_listing(acc_id, generation, query, cached)
+        return cached_response(cached)
+
     @is_json
     def post(self):
         schema = ContentSchema()
@@ -105,7 +265,9 @@ class Contents(Resource):
             content.total_records = data['total_records']
             content.success_records = data['success_records']
             content.error_records = data['error_records']
+            event = status_event(content)
             content.commit()
+            publish(data['account_id'], [event])
             return {}, 200
 
         except KeyError:
@@ -116,27 +278,151 @@ class Contents(Resource):
             return {}, 500
 
 
+@api.resource('/contents/batch')
+class ContentsBatch(Resource):
+    method_decorators = [token_required()]
+
+    def post(self):
+        files = request.files.getlist('files')
+        if not files or len(files) > current_app.config['CONTENTS_BATCH_LIMIT']:
+            return {'error': 'malformed_request'}, 400
+
+        metadata = request.form.get('metadata')
+        try:
+            items = json.loads(metadata) if metadata else [
+                {'filename': f.filename, 'created_at': date.today().isoformat()}
+                for f in files]
+        except ValueError:
+            return {'error': 'malformed_request'}, 400
+        if not isinstance(items, list) or len(items) != len(files):
+            return {'error': 'malformed_request'}, 400
+
+        schema = ContentSchema(many=True)
+        result = schema.load(items)
+        if result.errors:
+            return {'error': 'malformed_request'}, 400
+        contents = result.data
+
+        codec = current_app.config['STORAGE_CODEC']
+        dedup = current_app.config['STORAGE_DEDUP']
+        storage = get_storage()
+        saved_keys, pending = [], []
+        try:
+            for content, file in zip(contents, files):
+                saved = saveFile(file.stream,
+                                 content.filename,
+                                 storage,
+                                 codec, dedup)
+                if saved.created:
+                    saved_keys.append(saved.filename_fs)
+                content.uuid = get_uuid()
+                content.account_id = g.payload['account_id']
+                attach_file(content, saved, codec)
+                if not reuse_result(content):
+                    content.status = Status.PROCESSING.value
+                    pending.append(content)
+                content.upload_at = datetime.now()
+
+            Content.save_all(contents,
+                             before_commit=lambda _: enqueue_many(pending))
+        except Exception:
+            discard_files(saved_keys, storage, dedup)
+            return {}, 500
+
+        reused = [status_event(content) for content in contents if content not in pending]
+        if reused:
+            publish(g.payload['account_id'], reused)
+
+        app_log.info(
+            f"batch upload, account_id={g.payload['account_id']}, count={len(contents)}")
+        schema = ContentSchema()
+        return {
+            'objects': [{
+                'content_id': content.uuid,
+                'data': schema.dump(content).data,
+                'links': {
+                    'content': api.url_for(ContentApi, content_uuid=content.uuid),
+                    'file': api.url_for(ContentFile, content_uuid=content.uuid)
+                }
+            } for content in contents]
+        }, 201
+
+    @is_json
+    def put(self):
+        if g.payload['role'] not in ('admin', 'robot'):
+            return {}, 403
+
+        results = request.json.get('results')
+        if not isinstance(results, list) or not results \
+                or len(results) > current_app.config['CONTENTS_BATCH_LIMIT']:
+            return {'error': 'malformed_request'}, 400
+
+        if not all(is_valid_result(result) for result in results):
+            return {'error': 'malformed_request'}, 400
+
+        try:
+            updated = Content.update_statuses(results)
+        except Exception:
+            return {}, 500
+
+        updated_ids = set(updated)
+        not_found = [result['content_id'] for result in results
+                     if result['content_id'] not in updated_ids]
+        return {'updated': updated, 'not_found': not_found}, 200
+
+
+@api.resource('/contents/events')
+class ContentEvents(Resource):
+    method_decorators = [token_required()]
+
+    def get(self):
+        acc_id = g.payload['account_id']
+        heartbeat = current_app.config['EVENTS_HEARTBEAT']
+        hub = current_app.extensions['content_events']
+        events = hub.subscribe(acc_id)
+        if events is None:
+            return {'error': 'too_many_streams'}, 503, {'Retry-After': str(heartbeat)}
+
+        stream = hub.stream(events, current_app.config['EVENTS_STREAM_TIMEOUT'], heartbeat)
+        response = Response(stream, mimetype='text/event-stream')
+        response.call_on_close(lambda: hub.unsubscribe(acc_id, events))
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+
 @api.resource('/contents/<content_uuid>')
 class ContentApi(Resource):
     method_decorators = [token_required()]
 
     def get(self, content_uuid):
+        acc_id = g.payload['account_id']
+        cache = current_app.extensions['content_cache']
+        version = cache.version(acc_id, content_uuid)
+        cached = cache.get_doc(acc_id, version, content_uuid)
+        if cached is not None:
+            return cached_response(cached)
+
         try:
-            content = Content\
-                .find_by_content_uuid(g.payload['account_id'], content_uuid)
+            content = Content.find_by_content_uuid(acc_id, content_uuid)
         except EntityNotFoundError:
             return {}, 404
         except Exception:
             return {}, 500
 
         schema = ContentSchema(exclude=('content_id'))
-        return {
-            'content_id': content_uuid,
-            'data': schema.dump(content).data,
-            'links': {
-                'file': api.url_for(ContentFile, content_uuid=content_uuid)
+        cached = {
+            'etag': content_etag(content),
+            'body': {
+                'content_id': content_uuid,
+                'data': schema.dump(content).data,
+                'links': {
+                    'file': api.url_for(ContentFile, content_uuid=content_uuid)
+                }
             }
         }
+        cache.set_doc(acc_id, version, content_uuid, cached)
+        return cached_response(cached)
 
     @is_json
     def put(self, content_uuid):
@@ -176,6 +462,9 @@ class ContentApi(Resource):
             content = Content.find_by_content_uuid(
                 g.payload['account_id'], content_uuid)
 
+            if content.digest and not content.deleted \
+                    and current_app.config['STORAGE_DEDUP']:
+                Blob.release(content.filename_fs)
             content.deleted = True
             content.commit()
             return {}, 204
@@ -204,14 +493,24 @@ class ContentFile(Resource):
             return {"error": "file_not_upload"}, 400
 
         try:
-            data = readFile(content.path_file)
+            storage = get_storage()
+            if not content.codec:
+                return sendFile(storage, content.filename_fs)
+
+            if request.accept_encodings[content.codec] > 0:
+                response = sendFile(storage, content.filename_fs)
+                response.headers['Content-Encoding'] = content.codec
+            else:
+                response = Response(streamFile(storage, content.filename_fs, content.codec),
+                                    mimetype='application/xml')
+                response.content_length = content.file_size
+            response.vary.add('Accept-Encoding')
+            return response
+        except RequestedRangeNotSatisfiable:
+            return {'error': 'range_not_satisfiable'}, 416
         except Exception:
             return {}, 500
 
-        response = make_response(data)
-        response.headers['Content-type'] = 'application/xml'
-        return response
-
     def put(self, content_uuid):
         try:
             content = Content.find_by_content_uuid(
@@ -225,19 +524,178 @@ class ContentFile(Resource):
             return {"error": "file_alredy_upload"}, 400
 
         try:
-            content.path_file, content.filename_fs = saveFile(request.stream,
-                                                              content.filename,
-                                                              current_app.config['UPLOAD_FOLDER'])
-
-            enqueue(content)
+            reader = DigestReader(request.stream, requestDigests(request.headers))
+        except ValueError:
+            return {'error': 'malformed_request'}, 400
 
-            content.status = Status.PROCESSING.value
-            content.upload_at = datetime.now()
-            content.commit()
+        try:
+            stream = requestStream(request, reader)
+        except ValueError:
+            return {"error": "unsupported_content_encoding"}, 415
 
-            app_log.info(
-                f"""file_upload, content_id={content.id},
-                fname={content.filename}, fname_in_fs={content.filename_fs}""")
-            return {}, 200
+        storage, dedup = get_storage(), current_app.config['STORAGE_DEDUP']
+        try:
+            codec = current_app.config['STORAGE_CODEC']
+            saved = saveFile(stream,
+                             content.filename,
+                             storage,
+                             codec,
+                             dedup,
+                             reader.verify)
+        except DigestMismatchError:
+            return {"error": "digest_mismatch"}, 400
         except Exception as e:
             return {}, 500
+
+        try:
+            complete_upload(content, saved, codec)
+        except Exception:
+            discard_files([saved.filename_fs] if saved.created else [], storage, dedup)
+            return {}, 500
+        return {}, 200
+
+
+@api.resource('/contents/<content_uuid>/upload')
+class ContentUpload(Resource):
+    method_decorators = [token_required()]
+
+    def post(self, content_uuid):
+        try:
+            content = Content.find_by_content_uuid(
+                g.payload['account_id'], content_uuid)
+        except EntityNotFoundError:
+            return {}, 404
+        except Exception:
+            return {}, 500
+
+        if content.status != Status.UPLOADING.value:
+            return {"error": "file_alredy_upload"}, 400
+
+        path = stagingPath(current_app.config['UPLOAD_FOLDER'], content.uuid)
+        try:
+            open(path, 'ab').close()
+            offset = stagingOffset(path)
+        except Exception:
+            return {}, 500
+
+        app_log.info(
+            f"upload initiate, content_id={content.id}, offset={offset}")
+        return {
+            'offset': offset,
+            'links': {
+                'upload': api.url_for(ContentUpload, content_uuid=content.uuid),
+                'finalize': api.url_for(ContentUploadFinalize, content_uuid=content.uuid)
+            }
+        }, 201
+
+    def get(self, content_uuid):
+        try:
+            content = Content.find_by_content_uuid(
+                g.payload['account_id'], content_uuid)
+        except EntityNotFoundError:
+            return {}, 404
+        except Exception:
+            return {}, 500
+
+        path = stagingPath(current_app.config['UPLOAD_FOLDER'], content.uuid)
+        try:
+            offset = stagingOffset(path)
+        except UploadNotFoundError:
+            return {"error": "upload_not_initiated"}, 404
+
+        return {'offset': offset}, 200, {'Upload-Offset': str(offset)}
+
+    def patch(self, content_uuid):
+        offset = request.headers.get('Upload-Offset', None, type=int)
+        if offset is None:
+            return {'error': 'malformed_request'}, 400
+
+        try:
+            content = Content.find_by_content_uuid(
+                g.payload['account_id'], content_uuid)
+        except EntityNotFoundError:
+            return {}, 404
+        except Exception:
+            return {}, 500
+
+        if content.status != Status.UPLOADING.value:
+            return {"error": "file_alredy_upload"}, 400
+
+        try:
+            reader = DigestReader(request.stream, requestDigests(request.headers))
+        except ValueError:
+            return {'error': 'malformed_request'}, 400
+
+        try:
+            stream = requestStream(request, reader)
+        except ValueError:
+            return {"error": "unsupported_content_encoding"}, 415
+
+        path = stagingPath(current_app.config['UPLOAD_FOLDER'], content.uuid)
+        try:
+            offset = appendChunk(path, stream, offset, reader.verify)
+        except DigestMismatchError:
+            return {"error": "digest_mismatch"}, 400
+        except UploadNotFoundError:
+            return {"error": "upload_not_initiated"}, 404
+        except UploadOffsetError as e:
+            return {"error": "offset_mismatch", "offset": e.offset}, 409,\
+                {'Upload-Offset': str(e.offset)}
+        except Exception:
+            return {}, 500
+
+        return {'offset': offset}, 200, {'Upload-Offset': str(offset)}
+
+
+@api.resource('/contents/<content_uuid>/upload/finalize')
+class ContentUploadFinalize(Resource):
+    method_decorators = [token_required()]
+
+    @is_json
+    def post(self, content_uuid):
+        checksum = request.json.get('sha256')
+        if not checksum:
+            return {'error': 'malformed_request'}, 400
+
+        try:
+            content = Content.find_by_content_uuid(
+                g.payload['account_id'], content_uuid)
+        except EntityNotFoundError:
+            return {}, 404
+        except Exception:
+            return {}, 500
+
+        if content.status != Status.UPLOADING.value:
+            return {"error": "file_alredy_upload"}, 400
+
+        path = stagingPath(current_app.config['UPLOAD_FOLDER'], content.uuid)
+        storage, dedup = get_storage(), current_app.config['STORAGE_DEDUP']
+        try:
+            with lockStaging(path) as f:
+                digest = fileDigest(path)
+                if digest != checksum.lower():
+                    # the staged bytes are unusable, restart the upload from zero
+                    f.truncate(0)
+                    app_log.info(
+                        f"upload checksum mismatch, staging reset, content_id={content.id}")
+                    return {"error": "checksum_mismatch", "offset": 0}, 400,\
+                        {'Upload-Offset': '0'}
+
+                codec = current_app.config['STORAGE_CODEC']
+                saved = promoteFile(path,
+                                    content.filename,
+                                    storage,
+                                    codec,
+                                    dedup,
+                                    digest)
+        except UploadNotFoundError:
+            return {"error": "upload_not_initiated"}, 404
+        except Exception:
+            return {}, 500
+
+        try:
+            complete_upload(content, saved, codec)
+        except Exception:
+            discard_files([saved.filename_fs] if saved.created else [], storage, dedup)
+            return {}, 500
+        return {}, 200
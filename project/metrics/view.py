@@ -0,0 +1,20 @@
+import logging
+from flask import Blueprint, g, jsonify, current_app
+
+from project.utils import token_required
+
+
+bp = Blueprint('metrics', __name__, url_prefix='/api/metrics')
+
+error_log = logging.getLogger("server.error")
+
+
+@bp.route('/redis')
+@token_required(json=True)
+def redis_metrics():
+    if g.payload['role'] != 'admin':
+        error_log.error(
+            f"metrics not allowed, acc_id={g.payload['account_id']}, role={g.payload['role']}")
+        return jsonify(error='not_allowed'), 403
+
+    return jsonify(current_app.extensions['redis_pool'].stats())
@@ -0,0 +1,27 @@
+"""index blacklist_token.blacklist_on for the revoked-token refresh window
+
+Revision ID: 3f6a1c8d5b29
+Revises: e2c8a4b6d913
+Create Date: 2026-10-18 15:10:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6a1c8d5b29'
+down_revision = 'e2c8a4b6d913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_blacklist_token_blacklist_on', 'blacklist_token',
+                        ['blacklist_on'], postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_blacklist_token_blacklist_on', table_name='blacklist_token',
+                      postgresql_concurrently=True)
@@ -0,0 +1,78 @@
+"""store revoked token hashes with their expiry instead of raw tokens (expand)
+
+Adds and backfills token_hash/expires_at next to token, which becomes
+nullable; instances of the previous release keep working. The NOT NULL
+constraints and the token drop are in 7c4d2a9e6b15, to be applied once no
+old instance is running.
+
+Revision ID: 5e7b2d9f1a84
+Revises: c41f9e7a3d12
+Create Date: 2026-10-18 12:20:00.000000
+
+"""
+import hashlib
+from datetime import datetime
+
+import jwt
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e7b2d9f1a84'
+down_revision = 'c41f9e7a3d12'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def token_expiry(token):
+    try:
+        return datetime.utcfromtimestamp(jwt.decode(token, verify=False)['exp'])
+    except (jwt.InvalidTokenError, KeyError):
+        return datetime.utcnow()
+
+
+def upgrade():
+    op.add_column('blacklist_token', sa.Column('token_hash', sa.String(length=64), nullable=True))
+    op.add_column('blacklist_token', sa.Column('expires_at', sa.DateTime(), nullable=True))
+    op.alter_column('blacklist_token', 'token', nullable=True)
+
+    conn = op.get_bind()
+    select = sa.text("""
+        SELECT id, token FROM blacklist_token
+        WHERE id > :last_id AND token_hash IS NULL
+        ORDER BY id LIMIT :limit""")
+    update = sa.text("""
+        UPDATE blacklist_token SET token_hash = :token_hash, expires_at = :expires_at
+        WHERE id = :id""")
+
+    # every batch commits on its own so row locks stay short
+    with op.get_context().autocommit_block():
+        last_id = 0
+        while True:
+            rows = conn.execute(select, last_id=last_id, limit=BATCH_SIZE).fetchall()
+            if not rows:
+                break
+            conn.execute(update, [{
+                'id': row.id,
+                'token_hash': hashlib.sha256(row.token.encode('utf-8')).hexdigest(),
+                'expires_at': token_expiry(row.token)
+            } for row in rows])
+            last_id = rows[-1].id
+
+        op.create_index('blacklist_token_token_hash_key', 'blacklist_token',
+                        ['token_hash'], unique=True, postgresql_concurrently=True)
+        op.create_index('ix_blacklist_token_expires_at', 'blacklist_token',
+                        ['expires_at'], postgresql_concurrently=True)
+
+
+def downgrade():
+    # rows revoked by the new release carry no raw token and cannot be kept
+    op.execute('DELETE FROM blacklist_token WHERE token IS NULL')
+    op.alter_column('blacklist_token', 'token', nullable=False)
+    op.drop_index('ix_blacklist_token_expires_at', table_name='blacklist_token')
+    op.drop_index('blacklist_token_token_hash_key', table_name='blacklist_token')
+    op.drop_column('blacklist_token', 'expires_at')
+    op.drop_column('blacklist_token', 'token_hash')
@@ -0,0 +1,80 @@
+"""require token_hash/expires_at and drop the raw token column (contract)
+
+Apply only after every instance runs a release that writes token hashes
+(5e7b2d9f1a84): rows the previous release revoked during the rollout are
+hashed here first.
+
+Revision ID: 7c4d2a9e6b15
+Revises: 3f6a1c8d5b29
+Create Date: 2026-10-18 16:40:00.000000
+
+"""
+import hashlib
+from datetime import datetime
+
+import jwt
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c4d2a9e6b15'
+down_revision = '3f6a1c8d5b29'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def token_expiry(token):
+    try:
+        return datetime.utcfromtimestamp(jwt.decode(token, verify=False)['exp'])
+    except (jwt.InvalidTokenError, KeyError):
+        return datetime.utcnow()
+
+
+def upgrade():
+    conn = op.get_bind()
+    select = sa.text("""
+        SELECT id, token FROM blacklist_token
+        WHERE id > :last_id AND token_hash IS NULL AND token IS NOT NULL
+        ORDER BY id LIMIT :limit""")
+    update = sa.text("""
+        UPDATE blacklist_token SET token_hash = :token_hash, expires_at = :expires_at
+        WHERE id = :id""")
+
+    with op.get_context().autocommit_block():
+        last_id = 0
+        while True:
+            rows = conn.execute(select, last_id=last_id, limit=BATCH_SIZE).fetchall()
+            if not rows:
+                break
+            conn.execute(update, [{
+                'id': row.id,
+                'token_hash': hashlib.sha256(row.token.encode('utf-8')).hexdigest(),
+                'expires_at': token_expiry(row.token)
+            } for row in rows])
+            last_id = rows[-1].id
+
+        # validating a NOT VALID check takes no exclusive lock, and lets
+        # SET NOT NULL skip its own full-table scan
+        op.execute('ALTER TABLE blacklist_token ADD CONSTRAINT blacklist_token_hash_not_null '
+                   'CHECK (token_hash IS NOT NULL AND expires_at IS NOT NULL) NOT VALID')
+        op.execute('ALTER TABLE blacklist_token VALIDATE CONSTRAINT blacklist_token_hash_not_null')
+
+    op.execute('ALTER TABLE blacklist_token ADD CONSTRAINT blacklist_token_token_hash_key '
+               'UNIQUE USING INDEX blacklist_token_token_hash_key')
+    op.alter_column('blacklist_token', 'token_hash', nullable=False)
+    op.alter_column('blacklist_token', 'expires_at', nullable=False)
+    op.drop_constraint('blacklist_token_hash_not_null', 'blacklist_token', type_='check')
+    op.drop_column('blacklist_token', 'token')
+
+
+def downgrade():
+    op.add_column('blacklist_token', sa.Column('token', sa.String(), nullable=True))
+    op.create_unique_constraint('blacklist_token_token_key', 'blacklist_token', ['token'])
+    op.alter_column('blacklist_token', 'expires_at', nullable=True)
+    op.alter_column('blacklist_token', 'token_hash', nullable=True)
+    op.drop_constraint('blacklist_token_token_hash_key', 'blacklist_token', type_='unique')
+    op.create_index('blacklist_token_token_hash_key', 'blacklist_token',
+                    ['token_hash'], unique=True)
@@ -0,0 +1,67 @@
+"""baseline schema created by the original init-db
+
+Revision ID: 8a1d3c5e2b70
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a1d3c5e2b70'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'account',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(), nullable=False),
+        sa.Column('email', sa.String(), nullable=False),
+        sa.Column('create_at', sa.DateTime(), nullable=True),
+        sa.Column('modified_at', sa.DateTime(), nullable=True),
+        sa.Column('deleted', sa.Boolean(), nullable=True),
+        sa.Column('passwdchg', sa.Boolean(), nullable=True),
+        sa.Column('password', sa.String(), nullable=False),
+        sa.Column('role', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('username')
+    )
+    op.create_table(
+        'blacklist_token',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('token', sa.String(), nullable=False),
+        sa.Column('blacklist_on', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('token')
+    )
+    op.create_table(
+        'content',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('uuid', sa.String(), nullable=False),
+        sa.Column('account_id', sa.Integer(), nullable=False),
+        sa.Column('filename', sa.String(), nullable=False),
+        sa.Column('filename_fs', sa.String(), nullable=True),
+        sa.Column('status', sa.String(), nullable=True),
+        sa.Column('total_records', sa.Integer(), nullable=True),
+        sa.Column('success_records', sa.Integer(), nullable=True),
+        sa.Column('error_records', sa.Integer(), nullable=True),
+        sa.Column('deleted', sa.Boolean(), nullable=True),
+        sa.Column('path_file', sa.String(), nullable=True),
+        sa.Column('created_at', sa.Date(), nullable=True),
+        sa.Column('upload_at', sa.DateTime(), nullable=True),
+        sa.Column('modified_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['account_id'], ['account.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('uuid')
+    )
+
+
+def downgrade():
+    op.drop_table('content')
+    op.drop_table('blacklist_token')
+    op.drop_table('account')
@@ -0,0 +1,52 @@
+"""content access path indexes, built concurrently
+
+Revision ID: 9b3e6f0c2a57
+Revises: 5e7b2d9f1a84
+Create Date: 2026-10-18 12:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b3e6f0c2a57'
+down_revision = '5e7b2d9f1a84'
+branch_labels = None
+depends_on = None
+
+NOT_DELETED = sa.text('deleted = false')
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    # a failed concurrent build leaves an INVALID index behind: drop it and rerun
+    with op.get_context().autocommit_block():
+        op.create_index('ix_content_digest', 'content', ['digest'],
+                        postgresql_concurrently=True)
+        op.create_index('ix_content_account_id_id', 'content',
+                        ['account_id', 'id'],
+                        postgresql_where=NOT_DELETED,
+                        postgresql_concurrently=True)
+        op.create_index('ix_content_account_id_status', 'content',
+                        ['account_id', 'status'],
+                        postgresql_where=NOT_DELETED,
+                        postgresql_concurrently=True)
+        op.create_index('ix_content_account_id_filename', 'content',
+                        ['account_id', 'filename'],
+                        postgresql_where=NOT_DELETED,
+                        postgresql_concurrently=True)
+        op.create_index('ix_content_filename_trgm', 'content', ['filename'],
+                        postgresql_using='gin',
+                        postgresql_ops={'filename': 'gin_trgm_ops'},
+                        postgresql_where=NOT_DELETED,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name in ('ix_content_filename_trgm', 'ix_content_account_id_filename',
+                     'ix_content_account_id_status', 'ix_content_account_id_id',
+                     'ix_content_digest'):
+            op.drop_index(name, table_name='content', postgresql_concurrently=True)
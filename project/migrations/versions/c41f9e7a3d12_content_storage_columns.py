@@ -0,0 +1,40 @@
+"""content codec, size and digest columns; blob table
+
+Revision ID: c41f9e7a3d12
+Revises: 8a1d3c5e2b70
+Create Date: 2026-10-18 12:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41f9e7a3d12'
+down_revision = '8a1d3c5e2b70'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # nullable columns without defaults are catalog-only changes, no rewrite
+    op.add_column('content', sa.Column('codec', sa.String(), nullable=True))
+    op.add_column('content', sa.Column('file_size', sa.BigInteger(), nullable=True))
+    op.add_column('content', sa.Column('stored_size', sa.BigInteger(), nullable=True))
+    op.add_column('content', sa.Column('digest', sa.String(length=64), nullable=True))
+
+    op.create_table(
+        'blob',
+        sa.Column('filename_fs', sa.String(), nullable=False),
+        sa.Column('digest', sa.String(length=64), nullable=False),
+        sa.Column('ref_count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('filename_fs')
+    )
+
+
+def downgrade():
+    op.drop_table('blob')
+    op.drop_column('content', 'digest')
+    op.drop_column('content', 'stored_size')
+    op.drop_column('content', 'file_size')
+    op.drop_column('content', 'codec')
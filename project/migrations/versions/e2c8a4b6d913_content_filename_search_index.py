@@ -0,0 +1,43 @@
+"""per-account trigram index for filename search
+
+Revision ID: e2c8a4b6d913
+Revises: 9b3e6f0c2a57
+Create Date: 2026-10-18 12:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2c8a4b6d913'
+down_revision = '9b3e6f0c2a57'
+branch_labels = None
+depends_on = None
+
+NOT_DELETED = sa.text('deleted = false')
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_content_account_id_filename_trgm', 'content',
+                        ['account_id', 'filename'],
+                        postgresql_using='gin',
+                        postgresql_ops={'filename': 'gin_trgm_ops'},
+                        postgresql_where=NOT_DELETED,
+                        postgresql_concurrently=True)
+        op.drop_index('ix_content_filename_trgm', table_name='content',
+                      postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_content_filename_trgm', 'content', ['filename'],
+                        postgresql_using='gin',
+                        postgresql_ops={'filename': 'gin_trgm_ops'},
+                        postgresql_where=NOT_DELETED,
+                        postgresql_concurrently=True)
+        op.drop_index('ix_content_account_id_filename_trgm', table_name='content',
+                      postgresql_concurrently=True)
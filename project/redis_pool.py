@@ -0,0 +1,47 @@
+import time
+import logging
+
+import redis
+
+app_log = logging.getLogger("server.app")
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    def __init__(self, *args, **kwargs):
+        self.checkouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        super().__init__(*args, **kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.monotonic()
+        try:
+            return super().get_connection(command_name, *keys, **options)
+        finally:
+            elapsed = time.monotonic() - start
+            self.checkouts += 1
+            self.wait_time_total += elapsed
+            self.wait_time_max = max(self.wait_time_max, elapsed)
+
+    def stats(self):
+        idle = sum(1 for conn in list(self.pool.queue) if conn is not None)
+        return {
+            'max_connections': self.max_connections,
+            'created_connections': len(self._connections),
+            'idle_connections': idle,
+            'in_use_connections': len(self._connections) - idle,
+            'checkouts': self.checkouts,
+            'wait_time_total': round(self.wait_time_total, 6),
+            'wait_time_max': round(self.wait_time_max, 6)
+        }
+
+
+def create_pool(app):
+    pool = InstrumentedConnectionPool.from_url(
+        app.config['REDIS_CONN_URL'],
+        max_connections=app.config['REDIS_MAX_CONNECTIONS'],
+        timeout=app.config['REDIS_POOL_TIMEOUT'],
+        health_check_interval=app.config['REDIS_HEALTH_CHECK_INTERVAL'])
+    app_log.info(
+        f"redis pool created, max_connections={pool.max_connections}")
+    return pool
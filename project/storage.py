@@ -0,0 +1,173 @@
+import os
+import hashlib
+import logging
+from contextlib import closing
+
+from flask import Response, request, send_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+app_log = logging.getLogger("server.app")
+
+CHUNK_SIZE = 64 * 1024
+
+
+def shardKey(name, depth=2):
+    prefix = hashlib.md5(name.encode()).hexdigest()
+    shards = [prefix[i * 2:i * 2 + 2] for i in range(depth)]
+    return os.path.join(*shards, name)
+
+
+def privateResponse(response):
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = 0
+    response.expires = None
+    return response
+
+
+class LocalStorage:
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.spool = self.root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def uri(self, key):
+        return self.path(key)
+
+    def put(self, src_path, key):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def touch(self, key):
+        os.utime(self.path(key))
+
+    def mtime(self, key):
+        return os.path.getmtime(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def send(self, key, mimetype='application/xml'):
+        return privateResponse(
+            send_file(self.path(key), mimetype=mimetype, conditional=True))
+
+
+class S3Storage:
+    def __init__(self, bucket, spool, prefix='', **client_kwargs):
+        if boto3 is None:
+            raise RuntimeError('boto3 is required for the s3 storage backend')
+        self.bucket = bucket
+        self.spool = os.path.abspath(spool)
+        self.prefix = prefix
+        self.client = boto3.client('s3', **client_kwargs)
+
+    def key(self, key):
+        return f'{self.prefix}{key}'
+
+    def uri(self, key):
+        return f's3://{self.bucket}/{self.key(key)}'
+
+    def put(self, src_path, key):
+        self.client.upload_file(src_path, self.bucket, self.key(key))
+        os.remove(src_path)
+
+    def head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(self.uri(key))
+            raise
+
+    def open(self, key):
+        try:
+            return self.client.get_object(
+                Bucket=self.bucket, Key=self.key(key))['Body']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(self.uri(key))
+            raise
+
+    def touch(self, key):
+        self.head(key)
+        self.client.copy_object(
+            Bucket=self.bucket, Key=self.key(key),
+            CopySource={'Bucket': self.bucket, 'Key': self.key(key)},
+            MetadataDirective='REPLACE')
+
+    def mtime(self, key):
+        return self.head(key)['LastModified'].timestamp()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(key))
+
+    def send(self, key, mimetype='application/xml'):
+        params = {'Bucket': self.bucket, 'Key': self.key(key)}
+        if request.if_none_match:
+            params['IfNoneMatch'] = request.if_none_match.to_header()
+        elif request.if_modified_since:
+            params['IfModifiedSince'] = request.if_modified_since
+        # S3 serves a single range only; a multi-range request gets the whole body
+        if request.range and len(request.range.ranges) == 1:
+            params['Range'] = request.range.to_header()
+
+        try:
+            obj = self.client.get_object(**params)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('304', 'NotModified'):
+                response = Response(status=304)
+                etag = e.response.get('ResponseMetadata', {})\
+                    .get('HTTPHeaders', {}).get('etag')
+                if etag:
+                    response.set_etag(etag.strip('"'))
+                return privateResponse(response)
+            if code in ('416', 'InvalidRange'):
+                raise RequestedRangeNotSatisfiable()
+            if code in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(self.uri(key))
+            raise
+
+        def generate():
+            with closing(obj['Body']) as body:
+                yield from body.iter_chunks(CHUNK_SIZE)
+
+        response = Response(generate(), mimetype=mimetype)
+        response.content_length = obj['ContentLength']
+        response.set_etag(obj['ETag'].strip('"'))
+        response.last_modified = obj['LastModified']
+        response.accept_ranges = 'bytes'
+        if obj.get('ContentRange'):
+            response.status_code = 206
+            response.headers['Content-Range'] = obj['ContentRange']
+        return privateResponse(response)
+
+
+def create_storage(app):
+    backend = app.config['STORAGE_BACKEND']
+    if backend == 'local':
+        storage = LocalStorage(app.config['UPLOAD_FOLDER'])
+    elif backend == 's3':
+        storage = S3Storage(app.config['STORAGE_S3_BUCKET'],
+                            app.config['UPLOAD_FOLDER'],
+                            app.config['STORAGE_S3_PREFIX'],
+                            endpoint_url=app.config['STORAGE_S3_ENDPOINT_URL'])
+    else:
+        raise ValueError(f'unsupported storage backend={backend}')
+    app_log.info(f"storage created, backend={backend}")
+    return storage
@@ -2,7 +2,7 @@ import unittest
 import os
 
 from project import create_app, init_db, db
-from project.auth.Token import decodeToken, createAccessToken
+from project.auth.Token import decodeToken, createAccessToken, createRefreshToken
 from project.account.models import Account
 
 
@@ -102,6 +102,42 @@ class AuthTest(unittest.TestCase):
         self.assertIsNotNone(payload)
         self.assertEqual(resp.status_code, 200)
 
+    def test_login_robot_refresh_token(self):
+        data = {
+            'username': 'robot',
+            'password': self.app.config['ROBOT_PWD']
+        }
+
+        resp = self.client.post("/api/auth/login", json=data)
+        refresh_token = resp.get_json()['refresh_token']
+
+        resp = self.client.post("/api/auth/refresh",
+                                headers={'Authorization': f'Bearer {refresh_token}'})
+        payload = decodeToken(resp.get_json()['access_token'])
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(payload['role'], 'robot')
+        self.assertEqual(payload['type'], 'access')
+
+    def test_refresh_with_access_token(self):
+        token = createAccessToken(2, 'robot')
+
+        resp = self.client.post("/api/auth/refresh",
+                                headers={'Authorization': f'Bearer {token}'})
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.get_json()['error'], 'invalid_token_type')
+
+    def test_refresh_token_not_accepted_as_access(self):
+        with self.app.app_context():
+            account = Account.find_by_username('robot')
+        token = createRefreshToken(account.id, account.role)
+
+        resp = self.client.get("/api/auth/logout",
+                               headers={'Authorization': f'Bearer {token}'})
+
+        self.assertEqual(resp.status_code, 401)
+
     def test_login_uncorrect_username(self):
         data = {
             'username': 'buba123',
@@ -166,6 +202,35 @@ class AuthTest(unittest.TestCase):
 
         self.assertEqual(resp.status_code, 200)
 
+    def test_logout_revokes_refresh_token(self):
+        data = {
+            'username': 'robot',
+            'password': self.app.config['ROBOT_PWD']
+        }
+        tokens = self.client.post("/api/auth/login", json=data).get_json()
+        headers = {'Authorization': f'Bearer {tokens["access_token"]}'}
+
+        resp = self.client.post("/api/auth/logout", headers=headers,
+                                json={'refresh_token': tokens['refresh_token']})
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.post("/api/auth/refresh",
+                                headers={'Authorization': f'Bearer {tokens["refresh_token"]}'})
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.get_json()['error'], 'refresh_token_revoked')
+
+    def test_logout_foreign_refresh_token(self):
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            robot = Account.find_by_username('robot')
+        headers = {'Authorization': f'Bearer {createAccessToken(account.id, account.role)}'}
+
+        resp = self.client.post("/api/auth/logout", headers=headers,
+                                json={'refresh_token': createRefreshToken(robot.id, robot.role)})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json()['error'], 'invalid_refresh_token')
+
     def test_logout_uncorrect_token(self):
         with self.app.app_context():
             account = Account.find_by_username('buba')
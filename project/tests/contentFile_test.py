@@ -1,11 +1,19 @@
+import io
 import os
+import base64
+import gzip
+import time
+import hashlib
+import shutil
+import tempfile
 import unittest
 
 from project import create_app, init_db, db
 from project.auth.Token import decodeToken, createAccessToken, createAccessToken
-from project.content.models import Content
+from project.content.models import Content, Blob
 from project.account.models import Account
 from project.utils import Status
+from project.content.utils import purgeStaging
 
 
 class ContentFile_Test(unittest.TestCase):
@@ -50,6 +58,45 @@ class ContentFile_Test(unittest.TestCase):
         self.assertEqual(content.status, Status.PROCESSING.value)
         self.assertTrue(os.path.isfile(content.path_file))
 
+    def test_upload_file_content_digest(self):
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            content = Content.find_by_content_uuid(account.id, 'uuid2')
+
+        with open(f'{self.path_test_file}/upload_test.xml', 'rb') as f:
+            raw = f.read()
+        sha256 = hashlib.sha256(raw)
+        headers = dict(self.headers, **{
+            'Content-Digest': f'sha-256=:{base64.b64encode(sha256.digest()).decode()}:'
+        })
+
+        resp = self.client.put(f"/api/contents/{content.uuid}/file",
+                               headers=headers, data=raw)
+        resp_content = self.client.get(f"/api/contents/{content.uuid}",
+                                        headers=self.headers)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp_content.get_json()['data']['digest'],
+                         sha256.hexdigest())
+        self.assertEqual(resp_content.get_json()['data']['file_size'], len(raw))
+
+    def test_upload_file_digest_mismatch(self):
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            content = Content.find_by_content_uuid(account.id, 'uuid2')
+
+        headers = dict(self.headers, **{
+            'Content-MD5': base64.b64encode(hashlib.md5(b'other').digest()).decode()
+        })
+        resp = self.client.put(f"/api/contents/{content.uuid}/file",
+                               headers=headers, data=b'<a/>')
+        with self.app.app_context():
+            content = Content.find_by_content_id(account.id, content.id)
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json()['error'], 'digest_mismatch')
+        self.assertEqual(content.status, Status.UPLOADING.value)
+
     def test_upload_file_invalid(self):
         with self.app.app_context():
             account = Account.find_by_username('buba')
@@ -62,3 +109,218 @@ class ContentFile_Test(unittest.TestCase):
 
         self.assertEqual(resp.status_code, 400)
         self.assertEqual(resp.get_json()['error'], 'file_alredy_upload')
+
+    def test_download_file_range_and_etag(self):
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            content = Content.find_by_content_uuid(account.id, 'uuid2')
+
+        with open(f'{self.path_test_file}/upload_test.xml') as f:
+            self.client.put(f"/api/contents/{content.uuid}/file",
+                            headers=self.headers,
+                            data=f)
+        with self.app.app_context():
+            content = Content.find_by_content_id(
+                content.account_id, content.id)
+            content.status = Status.SUCCESS.value
+            content.commit()
+
+        url = f"/api/contents/{content.uuid}/file"
+        resp = self.client.get(url, headers=self.headers)
+        etag = resp.headers['ETag']
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNotNone(resp.headers.get('Last-Modified'))
+
+        headers = {**self.headers, 'Range': 'bytes=0-9'}
+        resp = self.client.get(url, headers=headers)
+
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(len(resp.data), 10)
+
+        headers = {**self.headers, 'If-None-Match': etag}
+        resp = self.client.get(url, headers=headers)
+
+        self.assertEqual(resp.status_code, 304)
+
+    def test_upload_file_gzip_encoded(self):
+        self.app.config['STORAGE_CODEC'] = 'gzip'
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            content = Content.find_by_content_uuid(account.id, 'uuid2')
+
+        with open(f'{self.path_test_file}/upload_test.xml', 'rb') as f:
+            raw = f.read()
+        headers = {**self.headers, 'Content-Encoding': 'gzip'}
+        resp = self.client.put(f"/api/contents/{content.uuid}/file",
+                               headers=headers,
+                               data=gzip.compress(raw))
+        with self.app.app_context():
+            content = Content.find_by_content_id(
+                content.account_id, content.id)
+            content.status = Status.SUCCESS.value
+            content.commit()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(content.codec, 'gzip')
+        self.assertEqual(content.file_size, len(raw))
+
+        url = f"/api/contents/{content.uuid}/file"
+        resp = self.client.get(url, headers={**self.headers,
+                                             'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.data), raw)
+
+        resp = self.client.get(url, headers={**self.headers,
+                                             'Accept-Encoding': 'identity'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, raw)
+
+    def test_resumable_upload_success(self):
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            content = Content.find_by_content_uuid(account.id, 'uuid2')
+
+        with open(f'{self.path_test_file}/upload_test.xml', 'rb') as f:
+            raw = f.read()
+        half = len(raw) // 2
+        url = f"/api/contents/{content.uuid}/upload"
+
+        resp = self.client.post(url, headers=self.headers)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.get_json()['offset'], 0)
+
+        resp = self.client.patch(url, data=raw[:half],
+                                 headers={**self.headers, 'Upload-Offset': '0'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['offset'], half)
+
+        resp = self.client.patch(url, data=raw[half:],
+                                 headers={**self.headers, 'Upload-Offset': '0'})
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(resp.get_json()['offset'], half)
+
+        resp = self.client.get(url, headers=self.headers)
+        self.assertEqual(resp.get_json()['offset'], half)
+
+        resp = self.client.patch(url, data=raw[half:],
+                                 headers={**self.headers, 'Upload-Offset': str(half)})
+        self.assertEqual(resp.get_json()['offset'], len(raw))
+
+        resp = self.client.post(f"{url}/finalize", headers=self.headers,
+                                json={'sha256': 'bad'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json()['error'], 'checksum_mismatch')
+        self.assertEqual(resp.get_json()['offset'], 0)
+
+        resp = self.client.patch(url, data=raw,
+                                 headers={**self.headers, 'Upload-Offset': '0'})
+        self.assertEqual(resp.get_json()['offset'], len(raw))
+
+        resp = self.client.post(f"{url}/finalize", headers=self.headers,
+                                json={'sha256': hashlib.sha256(raw).hexdigest()})
+        with self.app.app_context():
+            content = Content.find_by_content_id(
+                content.account_id, content.id)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(content.status, Status.PROCESSING.value)
+        self.assertEqual(content.file_size, len(raw))
+        self.assertTrue(os.path.isfile(content.path_file))
+
+    def test_purge_abandoned_staging(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        for name in ('stale.part', 'active.part', 'other.xml'):
+            open(os.path.join(folder, name), 'wb').close()
+        old = time.time() - 2 * 3600
+        for name in ('stale.part', 'other.xml'):
+            os.utime(os.path.join(folder, name), (old, old))
+
+        self.assertEqual(purgeStaging(folder, 3600), 1)
+        self.assertEqual(sorted(os.listdir(folder)), ['active.part', 'other.xml'])
+
+    def test_batch_upload_success(self):
+        with open(f'{self.path_test_file}/upload_test.xml', 'rb') as f:
+            raw = f.read()
+        data = {
+            'files': [(io.BytesIO(raw), 'batch1.xml'),
+                      (io.BytesIO(raw), 'batch2.xml')]
+        }
+
+        resp = self.client.post("/api/contents/batch", headers=self.headers,
+                                data=data, content_type='multipart/form-data')
+        objects = resp.get_json()['objects']
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual([o['data']['filename'] for o in objects],
+                         ['batch1.xml', 'batch2.xml'])
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            for obj in objects:
+                content = Content.find_by_content_uuid(
+                    account.id, obj['content_id'])
+                self.assertEqual(content.status, Status.PROCESSING.value)
+                self.assertTrue(os.path.isfile(content.path_file))
+
+    def test_dedup_upload_reuses_processed_file(self):
+        self.app.config['STORAGE_DEDUP'] = True
+        with open(f'{self.path_test_file}/upload_test.xml', 'rb') as f:
+            raw = f.read()
+
+        def upload(*names):
+            data = {'files': [(io.BytesIO(raw), name) for name in names]}
+            resp = self.client.post("/api/contents/batch", headers=self.headers,
+                                    data=data, content_type='multipart/form-data')
+            self.assertEqual(resp.status_code, 201)
+            return [o['content_id'] for o in resp.get_json()['objects']]
+
+        first, second = upload('dedup1.xml', 'dedup2.xml')
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            first = Content.find_by_content_uuid(account.id, first)
+            second = Content.find_by_content_uuid(account.id, second)
+            blob = Blob.query.get(first.filename_fs)
+
+            self.assertEqual(first.path_file, second.path_file)
+            self.assertEqual(first.digest, hashlib.sha256(raw).hexdigest())
+            self.assertEqual(blob.ref_count, 2)
+
+            Content.update_statuses([{
+                'account_id': account.id,
+                'content_id': first.id,
+                'status': Status.SUCCESS.value,
+                'total_records': 3,
+                'success_records': 3,
+                'error_records': 0
+            }])
+
+        third, = upload('dedup3.xml')
+        with self.app.app_context():
+            third = Content.find_by_content_uuid(account.id, third)
+
+            self.assertEqual(third.status, Status.SUCCESS.value)
+            self.assertEqual(third.total_records, 3)
+            self.assertEqual(Blob.query.get(third.filename_fs).ref_count, 3)
+
+        for content in (first, third):
+            self.client.delete(f"/api/contents/{content.uuid}", headers=self.headers)
+        fourth, = upload('dedup4.xml')
+        with self.app.app_context():
+            fourth = Content.find_by_content_uuid(account.id, fourth)
+
+            self.assertEqual(fourth.status, Status.PROCESSING.value)
+
+    def test_batch_upload_metadata_mismatch(self):
+        data = {
+            'files': [(io.BytesIO(b'<a/>'), 'batch1.xml')],
+            'metadata': '[]'
+        }
+
+        resp = self.client.post("/api/contents/batch", headers=self.headers,
+                                data=data, content_type='multipart/form-data')
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json()['error'], 'malformed_request')
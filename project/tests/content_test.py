@@ -1,4 +1,6 @@
 import os
+import time
+import json
 import unittest
 
 from project import create_app, init_db, db
@@ -6,6 +8,8 @@ from project.auth.Token import decodeToken, createAccessToken, createAccessToken
 from project.content.models import Content
 from project.account.models import Account
 from project.utils import Status
+from project.content.utils import get_redis, apply_results
+from sqlalchemy.dialects import postgresql
 
 
 class ContentTest(unittest.TestCase):
@@ -42,6 +46,86 @@ class ContentTest(unittest.TestCase):
         self.assertEquals(resp.status_code, 200)
         self.assertIsNotNone(resp.get_json())
 
+    def test_get_all_contents_status_counts(self):
+        resp = self.client.get("/api/contents", headers=self.headers)
+        resp_data = resp.get_json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp_data['total_contents'], 2)
+        self.assertEqual(resp_data['success_status'], 1)
+        self.assertEqual(resp_data['error_status'], 0)
+        self.assertEqual(resp_data['process_status'], 0)
+        self.assertEqual(resp_data['uploading_status'], 1)
+
+    def test_get_all_contents_pagination(self):
+        resp = self.client.get("/api/contents?limit=1", headers=self.headers)
+        resp_data = resp.get_json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp_data['objects']), 1)
+        self.assertEqual(resp_data['objects'][0]['content_id'], 'uuid1')
+        self.assertIn('next', resp_data['links'])
+
+        resp = self.client.get(resp_data['links']['next'], headers=self.headers)
+        resp_data = resp.get_json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp_data['objects']), 1)
+        self.assertEqual(resp_data['objects'][0]['content_id'], 'uuid2')
+        self.assertNotIn('next', resp_data['links'])
+
+    def test_get_all_contents_invalid_cursor(self):
+        resp = self.client.get("/api/contents?cursor=abc", headers=self.headers)
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json()['error'], 'malformed_request')
+
+    def test_get_all_contents_fields(self):
+        resp = self.client.get("/api/contents?fields=filename,status",
+                               headers=self.headers)
+        data = resp.get_json()['objects'][0]['data']
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(set(data), {'filename', 'status'})
+
+    def test_get_all_contents_invalid_fields(self):
+        resp = self.client.get("/api/contents?fields=password",
+                               headers=self.headers)
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json()['error'], 'malformed_request')
+
+    def test_search_contents_ranking(self):
+        resp = self.client.get("/api/contents?q=upload", headers=self.headers)
+        resp_prefix = self.client.get("/api/contents?q=test", headers=self.headers)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([o['content_id'] for o in resp.get_json()['objects']],
+                         ['uuid2'])
+        self.assertEqual([o['content_id'] for o in resp_prefix.get_json()['objects']],
+                         ['uuid1', 'uuid2'])
+
+    def test_search_contents_filters_and_pagination(self):
+        resp = self.client.get("/api/contents?q=test&status=success",
+                               headers=self.headers)
+        resp_page = self.client.get("/api/contents?q=test&limit=1",
+                                    headers=self.headers)
+        resp_dates = self.client.get("/api/contents?q=test&created_to=2019-05-15",
+                                     headers=self.headers)
+
+        self.assertEqual([o['content_id'] for o in resp.get_json()['objects']],
+                         ['uuid1'])
+        self.assertEqual(len(resp_page.get_json()['objects']), 1)
+        self.assertIn('offset=1', resp_page.get_json()['links']['next'])
+        self.assertEqual(resp_dates.status_code, 404)
+
+    def test_search_contents_invalid_filter(self):
+        resp = self.client.get("/api/contents?q=test&created_from=yesterday",
+                               headers=self.headers)
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json()['error'], 'malformed_request')
+
     def test_create_content_success(self):
         data = {
             'filename': 'content_test.xml',
@@ -77,12 +161,172 @@ class ContentTest(unittest.TestCase):
         self.assertEqual(resp.get_json()['error'], 'malformed_request')
 
 
+    def test_batch_update_status_success(self):
+        token = createAccessToken(2, 'robot')
+        headers = {'Authorization': f'Bearer {token}'}
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            content = Content.find_by_content_uuid(account.id, 'uuid2')
+        data = {
+            'results': [{
+                'account_id': account.id,
+                'content_id': content.id,
+                'status': Status.SUCCESS.value,
+                'total_records': 10,
+                'success_records': 9,
+                'error_records': 1
+            }, {
+                'account_id': account.id,
+                'content_id': 1000,
+                'status': Status.ERROR.value
+            }]
+        }
+
+        resp = self.client.put("/api/contents/batch", json=data, headers=headers)
+        resp_data = resp.get_json()
+        with self.app.app_context():
+            content = Content.find_by_content_id(account.id, content.id)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp_data['updated'], [content.id])
+        self.assertEqual(resp_data['not_found'], [1000])
+        self.assertEqual(content.status, Status.SUCCESS.value)
+        self.assertEqual(content.success_records, 9)
+
+    def test_content_events_stream(self):
+        token = createAccessToken(2, 'robot')
+        headers = {'Authorization': f'Bearer {token}'}
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            content = Content.find_by_content_uuid(account.id, 'uuid2')
+
+        resp = self.client.get("/api/contents/events", headers=self.headers,
+                               buffered=False)
+        stream = iter(resp.response)
+        self.assertTrue(next(stream).startswith(b'retry:'))
+        time.sleep(0.5)
+
+        self.client.put("/api/contents", headers=headers, json={
+            'account_id': account.id,
+            'content_id': content.id,
+            'status': Status.SUCCESS.value,
+            'total_records': 10,
+            'success_records': 10,
+            'error_records': 0
+        })
+        event = next(stream)
+        resp.close()
+
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertTrue(event.startswith(b'event: status'))
+        self.assertIn(b'"content_id": "uuid2"', event)
+        self.assertIn(b'"status": "success"', event)
+
+    def test_content_events_stream_limit(self):
+        hub = self.app.extensions['content_events']
+        limit, hub.max_streams = hub.max_streams, 0
+        try:
+            resp = self.client.get("/api/contents/events", headers=self.headers)
+        finally:
+            hub.max_streams = limit
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.get_json()['error'], 'too_many_streams')
+
+    def test_batch_update_status_invalid_role(self):
+        resp = self.client.put("/api/contents/batch", json={'results': []},
+                               headers=self.headers)
+
+        self.assertEqual(resp.status_code, 403)
+
+    def test_apply_results_from_redis(self):
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            content = Content.find_by_content_uuid(account.id, 'uuid2')
+            result = {
+                'account_id': account.id,
+                'content_id': content.id,
+                'status': Status.ERROR.value
+            }
+            conn = get_redis()
+            conn.delete(self.app.config['RESULTS_QUEUE'])
+            conn.lpush(self.app.config['RESULTS_QUEUE'], json.dumps(result))
+
+            applied = apply_results(batch_size=10, timeout=1, once=True)
+            content = Content.find_by_content_id(account.id, content.id)
+
+            self.assertEqual(applied, 1)
+            self.assertEqual(content.status, Status.ERROR.value)
+
+    def test_apply_results_dead_letter(self):
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            content = Content.find_by_content_uuid(account.id, 'uuid2')
+            queue = self.app.config['RESULTS_QUEUE']
+            result = {
+                'account_id': account.id,
+                'content_id': content.id,
+                'status': Status.ERROR.value
+            }
+            bad_id = dict(result, content_id='not-an-int')
+            conn = get_redis()
+            conn.delete(queue, f'{queue}:dead')
+            conn.lpush(queue, 'not json', json.dumps(bad_id), json.dumps(result))
+
+            applied = apply_results(batch_size=10, timeout=1, once=True, consumer='test')
+
+            self.assertEqual(applied, 1)
+            self.assertEqual(conn.llen(f'{queue}:dead'), 2)
+            self.assertEqual(conn.llen(f'{queue}:processing:test'), 0)
+
     def test_getContent_Success(self):
         resp = self.client.get("/api/contents/uuid1", headers=self.headers)
 
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.get_json()['content_id'], 'uuid1')
     
+    def test_getContent_NotModified(self):
+        resp = self.client.get("/api/contents/uuid1", headers=self.headers)
+        etag = resp.headers['ETag']
+
+        resp_cached = self.client.get("/api/contents/uuid1",
+                                      headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.client.put("/api/contents/uuid1", json={'filename': 'renamed.xml'},
+                        headers=self.headers)
+        resp_changed = self.client.get("/api/contents/uuid1",
+                                       headers=dict(self.headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(resp_cached.status_code, 304)
+        self.assertEqual(resp_changed.status_code, 200)
+        self.assertEqual(resp_changed.get_json()['data']['filename'], 'renamed.xml')
+
+    def test_getContents_NotModified(self):
+        resp = self.client.get("/api/contents", headers=self.headers)
+        etag = resp.headers['ETag']
+
+        resp_cached = self.client.get("/api/contents",
+                                      headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.client.delete("/api/contents/uuid1", headers=self.headers)
+        resp_changed = self.client.get("/api/contents",
+                                       headers=dict(self.headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(resp_cached.status_code, 304)
+        self.assertEqual(resp_changed.status_code, 200)
+        self.assertEqual(resp_changed.get_json()['total_contents'],
+                         resp.get_json()['total_contents'] - 1)
+
+    def test_getContent_cached_per_document(self):
+        self.client.get("/api/contents/uuid1", headers=self.headers)
+        acc_id = decodeToken(self.token)['account_id']
+        cache = self.app.extensions['content_cache']
+        version = cache.version(acc_id, 'uuid1')
+
+        self.client.put("/api/contents/uuid2", json={'filename': 'renamed.xml'},
+                        headers=self.headers)
+
+        self.assertEqual(cache.version(acc_id, 'uuid1'), version)
+        self.assertIsNotNone(cache.get_doc(acc_id, version, 'uuid1'))
+
     def test_getContent_NotFound(self):
         resp = self.client.get("/api/contents/uuid100", headers=self.headers)
 
@@ -120,3 +364,35 @@ class ContentTest(unittest.TestCase):
 
     
 
+
+    def test_access_paths_use_indexes(self):
+        with self.app.app_context():
+            account = Account.find_by_username('buba')
+            base = Content.query.filter_by(account_id=account.id, deleted=False)
+            queries = {
+                'get_all': (Content.paginate(base, 100, 0),
+                            'ix_content_account_id_id'),
+                'find_by_content_uuid': (Content.query.filter_by(
+                    uuid='uuid1', account_id=account.id),
+                    'content_uuid_key'),
+                'count_by_status': (db.session.query(Content.status, db.func.count(Content.id))
+                    .filter(Content.account_id == account.id, Content.deleted == False)
+                    .group_by(Content.status),
+                    'ix_content_account_id_status'),
+                'find_by_filename': (base.filter(Content.filename == 'test.xml'),
+                                     'ix_content_account_id_filename'),
+                'find_by_filename_like': (base.filter(Content.filename.like('%test%')),
+                                          'ix_content_account_id_filename_trgm')
+            }
+
+            db.session.execute('SET LOCAL enable_seqscan = off')
+            for name, (query, index) in queries.items():
+                sql = str(query.statement.compile(
+                    dialect=postgresql.dialect(),
+                    compile_kwargs={'literal_binds': True}))
+                plan = '\n'.join(row[0] for row in db.session.execute(f'EXPLAIN {sql}'))
+
+                self.assertRegex(plan, rf'\b(?:using|on) {index}\b',
+                                 f'{name} does not use {index}:\n{plan}')
+                self.assertNotIn('Seq Scan on content', plan, name)
+            db.session.rollback()
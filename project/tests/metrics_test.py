@@ -0,0 +1,41 @@
+import os
+import unittest
+
+from project import create_app, init_db
+from project.auth.Token import createAccessToken
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['APP_CONFIG'] = 'project.config.TestConfig'
+        self.app = create_app()
+        app_config = os.getenv('APP_CONFIG', 'project.config.DevConfig')
+        self.app.config.from_object(app_config)
+        self.app.config['TESTING'] = True
+        self.app.config['DEBUG'] = False
+        self.client = self.app.test_client()
+
+        with self.app.app_context():
+            init_db()
+
+    def test_redis_metrics_success(self):
+        token = createAccessToken(1, 'admin')
+        headers = {'Authorization': f'Bearer {token}'}
+
+        resp = self.client.get("/api/metrics/redis", headers=headers)
+        resp_data = resp.get_json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp_data['max_connections'],
+                         self.app.config['REDIS_MAX_CONNECTIONS'])
+        self.assertIn('wait_time_max', resp_data)
+
+    def test_redis_metrics_invalid_role(self):
+        token = createAccessToken(1, 'user')
+        headers = {'Authorization': f'Bearer {token}'}
+
+        resp = self.client.get("/api/metrics/redis", headers=headers)
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertEqual(resp.get_json()['error'], 'not_allowed')
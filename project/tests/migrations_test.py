@@ -0,0 +1,47 @@
+import os
+import unittest
+
+from flask_migrate import upgrade, downgrade
+from sqlalchemy import inspect
+
+from project import create_app, init_db, db
+
+
+class Migrations_Test(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['APP_CONFIG'] = 'project.config.TestConfig'
+        self.app = create_app()
+        app_config = os.getenv('APP_CONFIG', 'project.config.DevConfig')
+        self.app.config.from_object(app_config)
+
+        with self.app.app_context():
+            db.drop_all()
+            db.session.execute('DROP TABLE IF EXISTS alembic_version')
+            db.session.commit()
+
+    def tearDown(self):
+        with self.app.app_context():
+            init_db()
+
+    def test_upgrade_head_matches_models(self):
+        with self.app.app_context():
+            upgrade()
+            inspector = inspect(db.engine)
+
+            self.assertEqual(set(inspector.get_table_names()),
+                             set(db.metadata.tables) | {'alembic_version'})
+            for table in db.metadata.tables.values():
+                columns = {column['name'] for column in inspector.get_columns(table.name)}
+                self.assertEqual(columns, set(table.columns.keys()), table.name)
+                indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+                self.assertTrue({index.name for index in table.indexes} <= indexes,
+                                table.name)
+
+    def test_downgrade_base(self):
+        with self.app.app_context():
+            upgrade()
+            downgrade(revision='base')
+            inspector = inspect(db.engine)
+
+            self.assertEqual(inspector.get_table_names(), ['alembic_version'])
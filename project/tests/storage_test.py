@@ -0,0 +1,118 @@
+import io
+import os
+import uuid
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask
+
+from project.storage import LocalStorage, S3Storage, shardKey, boto3
+from project.content.utils import saveFile, streamFile, fileDigest
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+
+class LocalStorage_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = LocalStorage(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_shardKey(self):
+        key = shardKey('test---123.xml')
+        self.assertEqual(len(key.split(os.sep)), 3)
+        self.assertEqual(key, shardKey('test---123.xml'))
+
+    def test_saveFile_sharded(self):
+        saved = saveFile(io.BytesIO(b'<a/>'), 'test.xml', self.storage)
+
+        self.assertEqual(len(saved.filename_fs.split(os.sep)), 3)
+        self.assertTrue(os.path.isfile(saved.path))
+        self.assertEqual(os.listdir(self.root), [saved.filename_fs.split(os.sep)[0]])
+
+    def test_streamFile_gzip(self):
+        saved = saveFile(io.BytesIO(b'<a/>' * 1000), 'test.xml', self.storage, 'gzip')
+
+        data = b''.join(streamFile(self.storage, saved.filename_fs, 'gzip'))
+        self.assertEqual(data, b'<a/>' * 1000)
+        self.assertLess(saved.stored_size, saved.size)
+
+
+@unittest.skipIf(boto3 is None, 'boto3 is not installed')
+class S3Storage_Test(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = None
+        cls.endpoint_url = os.getenv('S3_TEST_ENDPOINT_URL')
+        if not cls.endpoint_url:
+            if ThreadedMotoServer is None:
+                raise unittest.SkipTest('no S3 endpoint available')
+            os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+            os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+            os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+            cls.server = ThreadedMotoServer(port=0)
+            cls.server.start()
+            host, port = cls.server.get_host_and_port()
+            cls.endpoint_url = f'http://{host}:{port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server:
+            cls.server.stop()
+
+    def setUp(self):
+        self.spool = tempfile.mkdtemp()
+        self.bucket = f'test-{uuid.uuid4().hex[:8]}'
+        self.storage = S3Storage(self.bucket, self.spool, 'contents/',
+                                 endpoint_url=self.endpoint_url)
+        self.storage.client.create_bucket(Bucket=self.bucket)
+
+    def tearDown(self):
+        shutil.rmtree(self.spool)
+
+    def test_saveFile_streamFile(self):
+        raw = os.urandom(256 * 1024)
+        saved = saveFile(io.BytesIO(raw), 'test.xml', self.storage, 'gzip')
+
+        self.assertTrue(saved.path.startswith(f's3://{self.bucket}/contents/'))
+        self.assertEqual(os.listdir(self.spool), [])
+        self.assertEqual(b''.join(streamFile(self.storage, saved.filename_fs, 'gzip')), raw)
+
+    def test_touch_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            self.storage.touch('missing.xml')
+
+    def test_delete(self):
+        saved = saveFile(io.BytesIO(b'<a/>'), 'test.xml', self.storage)
+        self.storage.delete(saved.filename_fs)
+
+        with self.assertRaises(FileNotFoundError):
+            self.storage.open(saved.filename_fs)
+
+    def test_send_range(self):
+        saved = saveFile(io.BytesIO(b'<a/><b/>'), 'test.xml', self.storage)
+
+        with Flask(__name__).test_request_context(headers={'Range': 'bytes=0-3'}):
+            response = self.storage.send(saved.filename_fs)
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], 'bytes 0-3/8')
+        self.assertEqual(b''.join(response.response), b'<a/>')
+
+    def test_send_not_modified(self):
+        saved = saveFile(io.BytesIO(b'<a/>'), 'test.xml', self.storage)
+        with Flask(__name__).test_request_context():
+            etag = self.storage.send(saved.filename_fs).get_etag()[0]
+
+        with Flask(__name__).test_request_context(headers={'If-None-Match': f'"{etag}"'}):
+            response = self.storage.send(saved.filename_fs)
+
+        self.assertEqual(response.status_code, 304)
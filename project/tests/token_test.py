@@ -1,8 +1,14 @@
 import os
+import time
 import unittest
+from threading import Thread
+from unittest import mock
+from datetime import datetime, timedelta
 
 from project import create_app, init_db, db
 from project.auth.Token import createAccessToken, _token_required, extractToken
+from project.auth.cache import TokenCache, RevokedTokens
+from project.auth.models import BlacklistToken
 from project.Exceptions import *
 from jwt.exceptions import InvalidTokenError
 
@@ -61,8 +67,69 @@ class TokenTest(unittest.TestCase):
 
         with self.app.app_context():
             self.assertRaises(RevokedTokenError, _token_required, authHeader)
+
+    def test_token_required_revoked_cached_token(self):
+        token = createAccessToken(1, "role")
+        authHeader = f'Bearer {token}'
+
+        with self.app.app_context():
+            _token_required(authHeader)
+
+        resp = self.client.get("/api/auth/logout",
+                               headers={'Authorization': authHeader})
+        self.assertEqual(resp.status_code, 200)
+
+        with self.app.app_context():
+            self.assertRaises(RevokedTokenError, _token_required, authHeader)
+
+    def test_purge_expired_revoked_tokens(self):
+        with self.app.app_context():
+            BlacklistToken(token_hash='expired',
+                           expires_at=datetime.utcnow() - timedelta(hours=1)).save()
+            BlacklistToken(token_hash='active',
+                           expires_at=datetime.utcnow() + timedelta(hours=1)).save()
+
+            purged = BlacklistToken.purge_expired(batch_size=1)
+
+            self.assertEqual(purged, 1)
+            self.assertFalse(BlacklistToken.check_blacklist('expired'))
+            self.assertTrue(BlacklistToken.check_blacklist('active'))
+
+    def test_token_cache_evicts_least_recently_used(self):
+        cache = TokenCache(maxsize=2, ttl=60)
+        cache.set('a', {'account_id': 1})
+        cache.set('b', {'account_id': 2})
+        cache.get('a')
+        cache.set('c', {'account_id': 3})
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_token_cache_expires_entries(self):
+        cache = TokenCache(maxsize=2, ttl=0)
+        cache.set('a', {'account_id': 1})
+
+        self.assertIsNone(cache.get('a'))
         
 
     
     
 
+    def test_revoked_tokens_refresh_once_under_contention(self):
+        revoked = RevokedTokens(refresh_interval=60)
+        calls = []
+
+        def revoked_since(since):
+            calls.append(since)
+            time.sleep(0.05)
+            return []
+
+        with mock.patch.object(BlacklistToken, 'revoked_since', side_effect=revoked_since):
+            threads = [Thread(target=revoked.refresh) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
@@ -0,0 +1,392 @@
+import os
+import json
+import signal
+import socket
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+from config import config, configLogger
+from storage_robot import ApiConfig, createDbPool, procFile, retryBudget, checkLocalAccess,\
+    requeueBatches
+from utils import ResultBuffer, CircuitBreaker, CircuitOpenError, backoffDelay, permanentStatus
+from task_queue import BaseTaskQueue, REAP_SCRIPT
+
+
+logger = logging.getLogger('storage_robot')
+
+
+class AsyncRedisTaskQueue(BaseTaskQueue):
+    def __init__(self, conn_url, nameQueue, workerId=None, visibilityTimeout=3600):
+        super().__init__(conn_url, nameQueue,
+                         workerId or f'{socket.gethostname()}-{os.getpid()}-async',
+                         visibilityTimeout)
+
+    async def connect(self):
+        if self.conn is None:
+            try:
+                self.conn = aioredis.from_url(self.conn_url)
+                await self.conn.ping()
+                self.reap_script = self.conn.register_script(REAP_SCRIPT)
+                logger.info("connect to Redis server")
+            except RedisError as e:
+                self.conn = None
+                logger.critical(f"Redis server is not running, error={e}")
+                raise
+            await self.recoverTasks()
+        return self.conn
+
+    async def dequeueTask(self, timeout=5):
+        await self.connect()
+
+        tries, i = 3, 0
+        while True:
+            try:
+                await self.reapExpired()
+                task = await self.conn.brpoplpush(self.name_queue, self.processing_queue, timeout)
+                if task:
+                    await self.trackTask(task)
+                break
+            except RedisError as e:
+                if i < tries - 1:
+                    logger.error(f'robot pop error, attempt={i+1}, error={e}')
+                    await asyncio.sleep(10)
+                    i += 1
+                    continue
+                logger.critical(f'robot pop error, all attempt, error={e}')
+                raise
+
+        if not task:
+            return None
+
+        logger.info(f'robot pop task: {task}')
+        return task, json.loads(task)
+
+    async def trackTask(self, task):
+        await self.trackPipe(task).execute()
+        self.held.add(task)
+
+    async def extendLeases(self):
+        if self.held:
+            await self.leasePipe().execute()
+
+    async def ackTask(self, task):
+        await self.ackPipe(task).execute()
+        self.held.discard(task)
+        logger.info(f'task ack, task={task}')
+
+    async def publishResults(self, results, resultsQueue):
+        await self.publishPipe(results, resultsQueue).execute()
+        self.held.difference_update(task for task, _ in results)
+        logger.info(f'results published, cont_ids={[respData["content_id"] for _, respData in results]}')
+
+    async def deadLetter(self, task, record):
+        await self.deadPipe(task, record).execute()
+        self.held.discard(task)
+        logger.error(f'task dead-lettered, queue={self.dead_key}, task={task}, record={record}')
+
+    async def reapExpired(self):
+        for task in await self.reap_script(**self.reapArgs()):
+            logger.warning(f'task visibility timeout, redelivered, task={task}')
+
+    async def recoverTasks(self):
+        while True:
+            task = await self.conn.rpoplpush(self.processing_queue, self.name_queue)
+            if task is None:
+                return
+            await self.recoverPipe(task).execute()
+            logger.warning(f'task recovered from processing list, task={task}')
+
+    async def close(self):
+        if self.conn is not None:
+            await self.conn.close()
+
+
+class AsyncHttpClient():
+    def __init__(self, session, **kwargs):
+        self.api = ApiConfig(**kwargs)
+        self.session = session
+        self.token = None
+        self.refreshToken = None
+        self.loginLock = asyncio.Lock()
+        self.breaker = CircuitBreaker(kwargs['BREAKER_FAILURES'],
+                                      kwargs['BREAKER_RESET_TIMEOUT'])
+
+    async def updateContents(self, items):
+        cont_ids = [data['content_id'] for data, _ in items]
+        status, body = await self.authRequest('PUT', self.api.bulkUpdateEndpoint,
+                                              self.api.bulkUpdateData(items),
+                                              f'cont_ids={cont_ids}')
+        if body.get('not_found'):
+            logger.error(f'content_update not found, cont_ids={body["not_found"]}')
+        return status
+
+    async def ensureFreshToken(self):
+        if self.api.tokenExpiring(self.token):
+            await self.relogin(self.token)
+        return self.token
+
+    async def authRequest(self, httpMethod, url, respData, logCtx):
+        await self.ensureFreshToken()
+
+        for attempt in range(2):
+            token = self.token
+            headers = {'Authorization': f'Bearer {token}'}
+            status, body = await self.make_request(httpMethod, url, respData, headers=headers)
+            if status == 401 and attempt < 1:
+                logger.error(f'''content_update error attempt relogin, http_status={status},
+                            http_err_msg={body.get('error')}, {logCtx}''')
+                await self.relogin(token)
+                continue
+            if status >= 400:
+                logger.error(f'''content_update failed, http_status={status},
+                            permanent={permanentStatus(status)},
+                            http_err_msg={body.get('error')}, {logCtx}''')
+                raise aiohttp.ClientResponseError(None, (), status=status,
+                                                  message=str(body.get('error')))
+
+            logger.info(f'content_update success, {logCtx}')
+            return status, body
+
+    async def relogin(self, staleToken):
+        async with self.loginLock:
+            if self.token != staleToken and not self.api.tokenExpiring(self.token):
+                return
+
+            if self.refreshToken is not None:
+                headers = {'Authorization': f'Bearer {self.refreshToken}'}
+                status, body = await self.make_request('POST', self.api.refreshEndpoint, None,
+                                                       headers=headers)
+                if status < 400:
+                    self.token = body['access_token']
+                    logger.info('robot token refresh success')
+                    return
+                logger.error(f'token refresh failed, relogin, http_status={status}')
+                self.refreshToken = None
+
+            self.token = await self.login()
+
+    async def login(self):
+        status, body = await self.make_request('POST', self.api.loginEndpoint,
+                                               self.api.loginData())
+        if status >= 400:
+            logger.error(f'login faild, http_status={status}, http_err_msg={body.get("error")}')
+            raise aiohttp.ClientResponseError(None, (), status=status,
+                                              message=str(body.get('error')))
+        logger.info('robot login success')
+        self.refreshToken = body.get('refresh_token', self.refreshToken)
+        return body['access_token']
+
+    async def make_request(self, httpMethod, url, data, headers=None,
+                           tries=4, delay=5, backoff=2, maxDelay=60):
+        retryBudget.recordRequest()
+        resp, lastError = None, None
+        for i in range(tries):
+            if i > 0:
+                if not retryBudget.acquireRetry():
+                    logger.warning(f'retry budget exhausted, attempt={i+1}')
+                    break
+                await asyncio.sleep(backoffDelay(i - 1, delay, backoff, maxDelay))
+
+            self.breaker.check()
+            try:
+                async with self.session.request(httpMethod, url, json=data, headers=headers,
+                                                timeout=aiohttp.ClientTimeout(total=self.api.timeout)) as resp:
+                    body = await resp.json(content_type=None) or {}
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.breaker.recordFailure()
+                if i == tries - 1:
+                    raise
+                logger.warning(f'attempt={i+1}, error={e}')
+                resp, lastError = None, e
+                continue
+
+            if resp.status < 500:
+                self.breaker.recordSuccess()
+                return resp.status, body
+            self.breaker.recordFailure()
+            logger.warning(f'''http_server_error, http_status={resp.status},
+                           http_err_msg={body.get('error')}, attempt={i+1}''')
+
+        if resp is None:
+            raise lastError
+        return resp.status, body
+
+
+async def flushResults(resultBuffer, httpClient, taskQueue):
+    items = resultBuffer.drain()
+    if not items:
+        return
+
+    if config['RESULT_CHANNEL'] == 'redis':
+        try:
+            await taskQueue.publishResults(
+                [(task, httpClient.api.formRespData(data, results_proc)[0])
+                 for task, data, results_proc in items],
+                config['RESULTS_QUEUE'])
+        except RedisError as e:
+            resultBuffer.requeue(items)
+            logger.error(
+                f'results publish failed, keep buffered, count={len(items)}, error={e}')
+        return
+
+    batches = [items]
+    while batches:
+        batch = batches.pop()
+        try:
+            await httpClient.updateContents([(data, results_proc)
+                                             for _, data, results_proc in batch])
+        except aiohttp.ClientResponseError as e:
+            if not permanentStatus(e.status):
+                requeueBatches(resultBuffer, batches + [batch], e)
+                return
+            # split until the result the API rejects is alone, then dead-letter it
+            if len(batch) == 1:
+                task, data, results_proc = batch[0]
+                await taskQueue.deadLetter(task, {
+                    'result': httpClient.api.formRespData(data, results_proc)[0],
+                    'http_status': e.status, 'error': e.message})
+                continue
+            middle = len(batch) // 2
+            batches += [batch[middle:], batch[:middle]]
+            continue
+        except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+            requeueBatches(resultBuffer, batches + [batch], e)
+            return
+
+        for task, _, _ in batch:
+            await taskQueue.ackTask(task)
+
+
+async def flushLoop(resultBuffer, httpClient, taskQueue, stopEvent, minInterval=0.1):
+    while not stopEvent.is_set():
+        try:
+            await asyncio.wait_for(stopEvent.wait(), max(resultBuffer.window, minInterval))
+        except asyncio.TimeoutError:
+            pass
+        try:
+            if resultBuffer.due() or stopEvent.is_set():
+                await flushResults(resultBuffer, httpClient, taskQueue)
+        except Exception as e:
+            logger.exception(f'results flush loop error, count={len(resultBuffer)}, error={e}')
+
+
+async def handleTask(task, data, resultBuffer, httpClient, taskQueue, dbPool, executor):
+    loop = asyncio.get_event_loop()
+    try:
+        results_proc = await loop.run_in_executor(executor, procFile, data, dbPool)
+    except Exception as e:
+        logger.error(
+            f'task failed, left for redelivery, cont_id={data["content_id"]}, error={e}')
+        # stop renewing its lease so the reaper hands it to another worker
+        taskQueue.held.discard(task)
+        return
+
+    resultBuffer.add((task, data, results_proc))
+    if len(resultBuffer) >= resultBuffer.max_size:
+        await flushResults(resultBuffer, httpClient, taskQueue)
+
+
+async def tokenRefresher(httpClient, stopEvent):
+    while not stopEvent.is_set():
+        try:
+            await asyncio.wait_for(stopEvent.wait(), config['TOKEN_CHECK_INTERVAL'])
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await httpClient.ensureFreshToken()
+        except Exception as e:
+            logger.error(f'background token refresh failed, error={e}')
+
+
+async def leaseKeeper(taskQueue, stopEvent):
+    interval = max(taskQueue.visibility_timeout / 3, 1)
+    while not stopEvent.is_set():
+        try:
+            await asyncio.wait_for(stopEvent.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await taskQueue.extendLeases()
+        except Exception as e:
+            logger.error(f'task lease extend failed, error={e}')
+
+
+async def runAsync(stopEvent):
+    concurrency = config['CONCURRENCY']
+    procWorkers = config['PROC_WORKERS']
+    slots = asyncio.Semaphore(concurrency)
+    executor = ThreadPoolExecutor(max_workers=procWorkers)
+    dbPool = createDbPool(maxSize=procWorkers)
+    resultBuffer = ResultBuffer(config['BATCH_SIZE'], config['BATCH_WINDOW'])
+    taskQueue = AsyncRedisTaskQueue(config['REDIS_CONN_URL'], config['REDIS_QUEUE'],
+                                    config.get('WORKER_ID'), config['VISIBILITY_TIMEOUT'])
+    running = set()
+
+    def taskDone(future):
+        running.discard(future)
+        slots.release()
+
+    logger.info(f'async robot on, concurrency={concurrency}, proc_workers={procWorkers}')
+    async with aiohttp.ClientSession() as session:
+        httpClient = AsyncHttpClient(session, **config)
+        flusher = asyncio.ensure_future(
+            flushLoop(resultBuffer, httpClient, taskQueue, stopEvent))
+        refresher = asyncio.ensure_future(tokenRefresher(httpClient, stopEvent))
+        leases = asyncio.ensure_future(leaseKeeper(taskQueue, stopEvent))
+        try:
+            while not stopEvent.is_set():
+                if resultBuffer.full():
+                    await flushResults(resultBuffer, httpClient, taskQueue)
+                    if resultBuffer.full():
+                        await asyncio.sleep(config['BREAKER_RESET_TIMEOUT'])
+                        continue
+
+                await slots.acquire()
+                try:
+                    item = await taskQueue.dequeueTask()
+                except Exception:
+                    slots.release()
+                    raise
+                if item is None:
+                    slots.release()
+                    continue
+
+                task, data = item
+                future = asyncio.ensure_future(handleTask(
+                    task, data, resultBuffer, httpClient, taskQueue, dbPool, executor))
+                running.add(future)
+                future.add_done_callback(taskDone)
+        finally:
+            logger.info(f'async robot stop, wait in-flight tasks, count={len(running)}')
+            await asyncio.gather(*running, return_exceptions=True)
+            stopEvent.set()
+            await flusher
+            refresher.cancel()
+            leases.cancel()
+            await flushResults(resultBuffer, httpClient, taskQueue)
+            await taskQueue.close()
+            executor.shutdown()
+            dbPool.closeAll()
+
+
+async def main():
+    stopEvent = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGTERM, stopEvent.set)
+    loop.add_signal_handler(signal.SIGINT, stopEvent.set)
+    await runAsync(stopEvent)
+
+
+if __name__ == "__main__":
+    configLogger()
+    try:
+        checkLocalAccess()
+        asyncio.run(main())
+    except Exception as e:
+        logger.critical(f'robot off, error={e}')
+    logger.info('robot off')
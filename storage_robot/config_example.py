@@ -6,14 +6,38 @@ host = 'http://127.0.0.1'
 port = '5000'
 config = {
     'MSSQL_CONN_URL': 'DRIVER={ODBC Driver 17 for SQL Server};SERVER=;DATABASE=;UID=;PWD=;',
+    'DB_CONN_MAX_AGE': 3600,
     'REDIS_CONN_URL': '',
     'REDIS_QUEUE': '',
+    'WORKER_ID': '',
+    'VISIBILITY_TIMEOUT': 3600,
+    'WORKERS': 1,
+    'HEALTH_INTERVAL': 30,
+    'CONCURRENCY': 8,
+    'PROC_WORKERS': 4,
     'PASSWD': '',
     'PROC': '',
+    'UPLOAD_FOLDER': '',
+    'STORAGE_BACKEND': 'local',
+    'S3_BUCKET': '',
+    'S3_PREFIX': '',
+    'S3_ENDPOINT_URL': None,
     'ROBOT_PWD': '',
     'ROBOT_USERNAME': '',
-    'UPDATE_ENDPOINT': f'{host}:{port}/api/contents',
-    'LOGIN_ENDPOINT': f'{host}:{port}/api/auth/login'
+    'BULK_UPDATE_ENDPOINT': f'{host}:{port}/api/contents/batch',
+    'BATCH_SIZE': 50,
+    'BATCH_WINDOW': 5,
+    'RESULT_CHANNEL': 'http',
+    'RESULTS_QUEUE': 'results',
+    'HTTP_TIMEOUT': 30,
+    'RETRY_BUDGET_RATIO': 0.2,
+    'RETRY_BUDGET_MIN': 10,
+    'BREAKER_FAILURES': 5,
+    'BREAKER_RESET_TIMEOUT': 30,
+    'LOGIN_ENDPOINT': f'{host}:{port}/api/auth/login',
+    'REFRESH_ENDPOINT': f'{host}:{port}/api/auth/refresh',
+    'TOKEN_REFRESH_MARGIN': 600,
+    'TOKEN_CHECK_INTERVAL': 60
 }
 
 
@@ -1,19 +1,38 @@
 import os
 import sys
 import time
-import json
+import signal
+import uuid
+import socket
 import logging
+import threading
+import multiprocessing
 import pyodbc
-import redis
 import requests
 from enum import Enum
-from functools import wraps
+from functools import wraps, lru_cache
 
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException, ConnectionError, ConnectTimeout, HTTPError
 from redis.exceptions import RedisError
 
 from config import config, configLogger
-from utils import retry
+from utils import retry, errorMessage, permanentStatus, tokenExpiry, unpackFile, fetchFile, fileDigest, taskFilename,\
+    ConnectionPool, ResultBuffer, RetryBudget, CircuitBreaker, CircuitOpenError
+from task_queue import RedisTaskQueue
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+    ClientError = OSError
+
+
+logger = logging.getLogger('storage_robot')
+retryBudget = RetryBudget(config['RETRY_BUDGET_RATIO'], config['RETRY_BUDGET_MIN'])
+s3Client = None
+fileErrors = (OSError, ValueError, EOFError, ClientError)
 
 
 class Status(Enum):
@@ -23,150 +42,167 @@ class Status(Enum):
     UPLOADING = 'uploading'
 
 
-class RedisTaskQueue:
-    def __init__(self, conn_url, nameQueue):
-        self.conn_url = conn_url
-        self.name_queue = nameQueue
-        self.conn = None
+class ApiConfig():
+    """Endpoints, credentials and payload helpers shared by the sync and async clients."""
 
-    def getConn(self):
-        try:
-            redis_conn = redis.Redis().from_url(self.conn_url)
-            redis_conn.ping()
-            logger.info("connect to Redis server")
-            return redis_conn
-        except redis.ConnectionError as e:
-            logger.critical(f"Redis server is not running, error={e}")
-            raise
-    
-    def dequeueTask(self):
-        if self.conn is None:
-            self.conn = self.getConn()
-        
-        tries, i = 3, 0
-        while True:
-            try:
-                logger.info('robot wait task...')
-                task = self.conn.blpop(self.name_queue, 30)
-                logger.info(f'robot pop task: {task}')
-            except RedisError as e:
-                if i < tries - 1:
-                    logger.error(f'robot pop error, attempt={i+1}, error={e}')
-                    time.sleep(10)
-                    i += 1
-                    continue
-                else:
-                    logger.critical(f'robot pop error, all attempt, error={e}')
-                    raise
+    def __init__(self, **kwargs):
+        self.robotUsername = kwargs['ROBOT_USERNAME']
+        self.robotPwd = kwargs['ROBOT_PWD']
+        self.loginEndpoint = kwargs['LOGIN_ENDPOINT']
+        self.bulkUpdateEndpoint = kwargs['BULK_UPDATE_ENDPOINT']
+        self.refreshEndpoint = kwargs['REFRESH_ENDPOINT']
+        self.refreshMargin = kwargs['TOKEN_REFRESH_MARGIN']
+        self.timeout = kwargs['HTTP_TIMEOUT']
 
-            if not task:
-                logger.info(f'robot pop timeout, sleep...')
-                time.sleep(30)
-                continue
+    def tokenExpiring(self, token):
+        return token is None or tokenExpiry(token) - time.time() < self.refreshMargin
+
+    def loginData(self):
+        return {
+            'username': self.robotUsername,
+            'password': self.robotPwd
+        }
 
-            return json.loads(task[1])
+    def bulkUpdateData(self, items):
+        return {'results': [self.formRespData(data, results_proc)[0]
+                            for data, results_proc in items]}
 
-    def enqueueTask(self, conn):
-        data = {
-            'account_id': 2,
-            'content_id': 5,
-            'content_uuid': 'qwe123',
-            'file': 'test.xml'
+    def formRespData(self, data, results_proc):
+        acc_id = data['account_id']
+        cont_id = data['content_id']
+        respData = {
+            'account_id': acc_id,
+            'content_id': cont_id
         }
 
-        try:
-            conn.rpush(self.name_queue, json.dumps(data))
-        except Exception as e:
-            raise
+        if results_proc.get('status') == 'success':
+            respData.update({
+                'status': Status.SUCCESS.value,
+                'total_records': results_proc['total_records'],
+                'success_records': results_proc['success_records'],
+                'error_records': results_proc['error_records']
+            })
+        else:
+            respData.update({'status': Status.ERROR.value})
+
+        return respData, acc_id, cont_id
 
 
 class HttpClient():
     def __init__(self, **kwargs):
-        self.robotUsername = kwargs['ROBOT_USERNAME']
-        self.robotPwd = kwargs['ROBOT_PWD']
-        self.loginEndpoint = kwargs['LOGIN_ENDPOINT']
-        self.updateEndpoint = kwargs['UPDATE_ENDPOINT']
+        self.api = ApiConfig(**kwargs)
         self.token = None
+        self.refreshToken = None
+        self.tokenLock = threading.Lock()
+        self.breaker = CircuitBreaker(kwargs['BREAKER_FAILURES'],
+                                      kwargs['BREAKER_RESET_TIMEOUT'])
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def updateContents(self, items):
+        cont_ids = [data['content_id'] for data, _ in items]
+        resp = self.authRequest('PUT', self.api.bulkUpdateEndpoint, self.api.bulkUpdateData(items),
+                                f'cont_ids={cont_ids}')
+        notFound = resp.json().get('not_found')
+        if notFound:
+            logger.error(f'content_update not found, cont_ids={notFound}')
+        return resp.status_code
+
+    def ensureFreshToken(self):
+        if self.api.tokenExpiring(self.token):
+            self.renewToken(self.token)
+        return self.token
+
+    def renewToken(self, staleToken):
+        with self.tokenLock:
+            if self.token != staleToken and not self.api.tokenExpiring(self.token):
+                return self.token
+
+            if self.refreshToken is not None:
+                try:
+                    headers = {'Authorization': f'Bearer {self.refreshToken}'}
+                    resp = self.make_request('POST', self.api.refreshEndpoint, None, headers=headers)
+                    self.token = resp.json()['access_token']
+                    logger.info('robot token refresh success')
+                    return self.token
+                except HTTPError as e:
+                    logger.error(f'token refresh failed, relogin, error={e}')
+                    self.refreshToken = None
 
-    def updateContent(self, data, results_proc):
-        if self.token is None:
             self.token = self.login()
+            return self.token
+
+    def authRequest(self, httpMethod, url, respData, logCtx):
+        self.ensureFreshToken()
 
         headers = { 'Authorization': f'Bearer {self.token}' }
-        respData, acc_id, cont_id = self.formRespData(data, results_proc)
 
         for attempt in range(2):
             try:
-                resp = self.make_request('PUT', self.updateEndpoint, respData, headers=headers)
-                logger.info(
-                    f'content_update success, cont_id={cont_id}, acc_id={acc_id}')
-                return resp.status_code
+                resp = self.make_request(httpMethod, url, respData, headers=headers)
+                logger.info(f'content_update success, {logCtx}')
+                return resp
 
             except HTTPError as e:
-                error_msg = e.response.json().get('error')
+                error_msg = errorMessage(e.response)
                 
                 httpStatus = e.response.status_code
                 if httpStatus == 401 and attempt < 1:
                     logger.error(f'''content_update error attempt relogin, http_status={httpStatus}, 
-                                http_err_msg={error_msg}, cont_id={cont_id}, acc_id={acc_id}, error={e}''')
-                    self.token = self.login()
+                                http_err_msg={error_msg}, {logCtx}, error={e}''')
+                    self.renewToken(headers['Authorization'].split(' ')[1])
                     headers['Authorization'] = f'Bearer {self.token}'
-                    logger.info(
-                        f'relogin success, cont_id={cont_id}, acc_id={acc_id}')
+                    logger.info(f'relogin success, {logCtx}')
                     continue
                 else:
                     logger.error(f'''content_update failed, http_status={httpStatus},
-                                http_err_msg={error_msg}, cont_id={cont_id}, acc_id={acc_id}, error={e}''')
+                                permanent={permanentStatus(httpStatus)},
+                                http_err_msg={error_msg}, {logCtx}, error={e}''')
                     raise
             except Exception as e:
                 logger.error(f'''content_update failed,
-                            cont_id={cont_id}, acc_id={acc_id}, error={e}''')
+                            {logCtx}, error={e}''')
                 raise
 
     def login(self):
-        data = {
-            'username': self.robotUsername,
-            'password': self.robotPwd
-        }
-
         try:
-            resp = self.make_request('POST', self.loginEndpoint, data)
+            resp = self.make_request('POST', self.api.loginEndpoint, self.api.loginData())
             logger.info('robot login success')
-            return resp.json()['access_token']
+            tokens = resp.json()
+            self.refreshToken = tokens.get('refresh_token', self.refreshToken)
+            return tokens['access_token']
         except Exception as e:
             logger.error(f'login faild, error={e}')
             raise
 
-    @retry((ConnectionError, ConnectTimeout, HTTPError))
+    @retry((ConnectionError, ConnectTimeout, HTTPError), budget=retryBudget)
     def make_request(self, httpMethod, url, data, headers=None):
-        resp = requests.request(httpMethod, url, json=data, headers=headers)
-        resp.raise_for_status()
-        return resp
-
-    def formRespData(self, data, result_proc):
-        acc_id = data['account_id']
-        cont_id = data['content_id']
-        respData = {
-            'account_id': acc_id,
-            'content_id': cont_id
-        }
+        self.breaker.check()
+        try:
+            resp = self.session.request(httpMethod, url, json=data, headers=headers,
+                                        timeout=self.api.timeout)
+        except RequestException:
+            self.breaker.recordFailure()
+            raise
 
-        if results_proc.get('status') == 'success':
-            respData.update({
-                'status': Status.SUCCESS.value,
-                'total_records': results_proc['total_records'],
-                'success_records': results_proc['success_records'],
-                'error_records': results_proc['error_records']
-            })
+        if resp.status_code >= 500:
+            self.breaker.recordFailure()
         else:
-            respData.update({'status': Status.ERROR.value})
+            self.breaker.recordSuccess()
+        resp.raise_for_status()
+        return resp
 
-        return respData, acc_id, cont_id
 
+def createDbPool(maxSize=1):
+    return ConnectionPool(lambda: pyodbc.connect(config['MSSQL_CONN_URL']),
+                          maxSize=maxSize,
+                          maxAge=config['DB_CONN_MAX_AGE'],
+                          disconnectErrors=(pyodbc.OperationalError,))
 
 
-def callProc(filename):
-    conn = pyodbc.connect(config['MSSQL_CONN_URL'])
+def execProc(conn, filename):
     cursor = conn.cursor()
     # cmd = "{CALL %s } (?)" % (Config.PROC)
     try:
@@ -180,36 +216,295 @@ def callProc(filename):
             'success_records': success,
             'error_records': error
         }
+    finally:
+        cursor.close()
+
+
+def callProc(filename, dbPool):
+    # the import is not idempotent: retry only while the CALL has not been sent yet
+    for attempt in range(2):
+        sent = False
+        try:
+            with dbPool.connection() as conn:
+                dbPool.ping(conn)
+                sent = True
+                return execProc(conn, filename)
+
+        except pyodbc.OperationalError as e:
+            if not sent and attempt < 1:
+                logger.warning(f'call_proc connection error, reconnect, file={filename}, error={e}')
+                continue
+            logger.error(f'call_proc_error, file={filename}, sent={sent}, error={e}')
+            return {
+                'status': 'error'
+            }
+
+        except pyodbc.DatabaseError as e:
+            logger.error(f'call_proc_error, file={filename}, error={e}')
+            return {
+                'status': 'error'
+            }
+
+
+def getS3Client():
+    global s3Client
+    if s3Client is None:
+        if boto3 is None:
+            raise RuntimeError('boto3 is required for the s3 storage backend')
+        s3Client = boto3.client('s3', endpoint_url=config['S3_ENDPOINT_URL'])
+    return s3Client
+
 
-    except pyodbc.DatabaseError as e:
-        cursor.rollback()
-        logger.error(f'call_proc_error, file={filename}, error={e}')
+@lru_cache(maxsize=None)
+def checkLocalAccess():
+    folder = config['UPLOAD_FOLDER']
+    if folder and os.path.isdir(folder) and os.access(folder, os.R_OK | os.W_OK):
+        return True
+    if config['STORAGE_BACKEND'] == 's3':
+        raise RuntimeError(f'UPLOAD_FOLDER is not accessible, folder={folder!r}')
+    logger.warning(f'UPLOAD_FOLDER is not accessible, digest check skipped, folder={folder!r}')
+    return False
+
+
+def prepareFile(data, tag, localFiles):
+    filename = data['file']
+    if config['STORAGE_BACKEND'] == 's3':
+        filename = fetchFile(getS3Client(), config['S3_BUCKET'],
+                             config['S3_PREFIX'] + filename,
+                             config['UPLOAD_FOLDER'], taskFilename(filename, tag))
+        localFiles.append(filename)
+    if data.get('codec'):
+        filename = unpackFile(config['UPLOAD_FOLDER'], filename, data['codec'],
+                              taskFilename(os.path.splitext(data['file'])[0], tag))
+        localFiles.append(filename)
+    if data.get('digest') and checkLocalAccess() and \
+            fileDigest(os.path.join(config['UPLOAD_FOLDER'], filename)) != data['digest']:
+        raise ValueError(f'file digest mismatch, file={filename}')
+    return filename
+
+
+def procFile(data, dbPool):
+    localFiles = []
+    try:
+        filename = prepareFile(data, uuid.uuid4().hex, localFiles)
+    except fileErrors as e:
+        # a missing or corrupt file will not heal on redelivery
+        logger.error(f'file prepare failed, file={data["file"]}, error={e}')
+        removeFiles(localFiles)
         return {
             'status': 'error'
         }
 
+    try:
+        return callProc(filename, dbPool)
     finally:
-        cursor.close()
-        conn.close()
+        removeFiles(localFiles)
 
 
-if __name__ == "__main__":
-    configLogger()    
-    logger = logging.getLogger('storage_robot')
-    logger.info("robot on")
-    
-    taskQueue = RedisTaskQueue(config['REDIS_CONN_URL'], config['REDIS_QUEUE'])
+def removeFiles(localFiles):
+    for localFile in localFiles:
+        try:
+            os.remove(os.path.join(config['UPLOAD_FOLDER'], localFile))
+        except OSError as e:
+            logger.warning(f'local file remove failed, file={localFile}, error={e}')
+
+
+def flushResults(resultBuffer, httpClient, taskQueue):
+    items = resultBuffer.drain()
+    if not items:
+        return 0
+
+    if config['RESULT_CHANNEL'] == 'redis':
+        try:
+            taskQueue.publishResults(
+                [(task, httpClient.api.formRespData(data, results_proc)[0])
+                 for task, data, results_proc in items],
+                config['RESULTS_QUEUE'])
+        except RedisError as e:
+            resultBuffer.requeue(items)
+            logger.error(f'results publish failed, keep buffered, count={len(items)}, error={e}')
+            return 0
+        return len(items)
+
+    batches, sent = [items], 0
+    while batches:
+        batch = batches.pop()
+        try:
+            httpClient.updateContents([(data, results_proc) for _, data, results_proc in batch])
+        except HTTPError as e:
+            status = e.response.status_code
+            if not permanentStatus(status):
+                requeueBatches(resultBuffer, batches + [batch], e)
+                return sent
+            # split until the result the API rejects is alone, then dead-letter it
+            if len(batch) == 1:
+                task, data, results_proc = batch[0]
+                taskQueue.deadLetter(task, {
+                    'result': httpClient.api.formRespData(data, results_proc)[0],
+                    'http_status': status, 'error': errorMessage(e.response)})
+                continue
+            middle = len(batch) // 2
+            batches += [batch[middle:], batch[:middle]]
+            continue
+        except (RequestException, CircuitOpenError) as e:
+            requeueBatches(resultBuffer, batches + [batch], e)
+            return sent
+
+        for task, _, _ in batch:
+            taskQueue.ackTask(task)
+        sent += len(batch)
+    return sent
+
+
+def requeueBatches(resultBuffer, batches, error):
+    items = [item for batch in reversed(batches) for item in batch]
+    resultBuffer.requeue(items)
+    logger.error(f'results flush failed, keep buffered, count={len(items)}, error={error}')
+
+
+def runWorker(index, stopEvent):
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopEvent.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopEvent.set())
+
+    workerId = f"{config.get('WORKER_ID') or socket.gethostname()}-{index}"
+    taskQueue = RedisTaskQueue(config['REDIS_CONN_URL'], config['REDIS_QUEUE'],
+                               workerId, config['VISIBILITY_TIMEOUT'])
     httpClient = HttpClient(**config)
+    dbPool = createDbPool()
+    startTokenRefresher(httpClient, stopEvent)
+    logger.info(f'worker on, worker_id={workerId}, pid={os.getpid()}')
+
+    resultBuffer = ResultBuffer(config['BATCH_SIZE'], config['BATCH_WINDOW'])
+    flushLock = threading.Lock()
+    processed = 0
+
+    def flush(force=False):
+        nonlocal processed
+        with flushLock:
+            if force or resultBuffer.due():
+                processed += flushResults(resultBuffer, httpClient, taskQueue)
+            return resultBuffer.full()
+
+    # a slow procedure must not hold finished results past the window
+    startResultFlusher(flush, resultBuffer.window, stopEvent)
+    # nor let a held task (running or buffered) pass its visibility timeout
+    startLeaseKeeper(taskQueue, stopEvent)
 
     try:
-        while True:
-            data = taskQueue.dequeueTask()
-            results_proc = callProc(data['file'])
-            httpClient.updateContent(data, results_proc)
-    except KeyboardInterrupt:
-        logger.info('robot off')
-        sys.exit()
+        while not stopEvent.is_set():
+            if resultBuffer.full():
+                if flush(force=True):
+                    stopEvent.wait(config['BREAKER_RESET_TIMEOUT'])
+                    continue
+
+            item = taskQueue.dequeueTask(stopEvent)
+            if item is None:
+                flush(force=True)
+                taskQueue.reportHealth('idle', processed)
+                continue
+
+            task, data = item
+            taskQueue.reportHealth('busy', processed)
+            results_proc = procFile(data, dbPool)
+            with flushLock:
+                resultBuffer.add((task, data, results_proc))
+            flush()
+            taskQueue.reportHealth('idle', processed)
+
+        flush(force=True)
     except Exception as e:
-        logger.critical(f'robot off, error={e}')
-        sys.exit()
-    
+        logger.critical(f'worker off, worker_id={workerId}, error={e}')
+        taskQueue.reportHealth('failed', processed)
+        sys.exit(1)
+    finally:
+        dbPool.closeAll()
+
+    taskQueue.reportHealth('stopped', processed)
+    logger.info(f'worker off, worker_id={workerId}, processed={processed}')
+
+
+def resultFlusher(flush, window, stopEvent, minInterval=0.1):
+    while not stopEvent.wait(max(window, minInterval)):
+        try:
+            flush()
+        except Exception as e:
+            logger.exception(f'results flush error, error={e}')
+
+
+def startResultFlusher(flush, window, stopEvent):
+    thread = threading.Thread(target=resultFlusher, args=(flush, window, stopEvent),
+                              name='result-flusher', daemon=True)
+    thread.start()
+    return thread
+
+
+def leaseKeeper(taskQueue, stopEvent):
+    interval = max(taskQueue.visibility_timeout / 3, 1)
+    while not stopEvent.wait(interval):
+        try:
+            taskQueue.extendLeases()
+        except Exception as e:
+            logger.error(f'task lease extend failed, error={e}')
+
+
+def startLeaseKeeper(taskQueue, stopEvent):
+    thread = threading.Thread(target=leaseKeeper, args=(taskQueue, stopEvent),
+                              name='lease-keeper', daemon=True)
+    thread.start()
+    return thread
+
+
+def tokenRefresher(httpClient, stopEvent):
+    while not stopEvent.wait(config['TOKEN_CHECK_INTERVAL']):
+        try:
+            httpClient.ensureFreshToken()
+        except Exception as e:
+            logger.error(f'background token refresh failed, error={e}')
+
+
+def startTokenRefresher(httpClient, stopEvent):
+    thread = threading.Thread(target=tokenRefresher, args=(httpClient, stopEvent),
+                              name='token-refresher', daemon=True)
+    thread.start()
+    return thread
+
+
+def startWorker(index, stopEvent):
+    proc = multiprocessing.Process(target=runWorker, args=(index, stopEvent),
+                                   name=f'storage_robot-{index}')
+    proc.start()
+    return proc
+
+
+def supervise(workers, stopEvent):
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopEvent.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopEvent.set())
+
+    procs = {i: startWorker(i, stopEvent) for i in range(workers)}
+    while not stopEvent.wait(config['HEALTH_INTERVAL']):
+        for i, proc in procs.items():
+            if not proc.is_alive():
+                logger.error(
+                    f'worker died, index={i}, pid={proc.pid}, exitcode={proc.exitcode}, restart...')
+                procs[i] = startWorker(i, stopEvent)
+        alive = sum(proc.is_alive() for proc in procs.values())
+        logger.info(f'supervisor health, workers_alive={alive}/{workers}')
+
+    logger.info('supervisor stop, wait workers finish in-flight tasks...')
+    for proc in procs.values():
+        proc.join()
+
+
+if __name__ == "__main__":
+    configLogger()
+    checkLocalAccess()
+    logger.info("robot on")
+
+    stopEvent = multiprocessing.Event()
+    workers = int(config.get('WORKERS') or 1)
+    if workers > 1:
+        supervise(workers, stopEvent)
+    else:
+        runWorker(0, stopEvent)
+
+    logger.info('robot off')
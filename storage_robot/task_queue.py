@@ -0,0 +1,231 @@
+import os
+import time
+import json
+import socket
+import logging
+
+import redis
+from redis.exceptions import RedisError
+
+
+logger = logging.getLogger('storage_robot')
+
+MEMBER_SEP = b'\x00'
+REAP_LIMIT = 100
+
+# inflight members are b'<processing list>\0<task>': one per delivery, so the
+# reaper knows the owner and a late ack cannot clear someone else's copy.
+# Expire, unlink from the owner and requeue in one step, so a concurrent ack
+# either wins (and there is nothing to redeliver) or finds nothing to ack.
+REAP_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local redelivered = {}
+for _, member in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], member)
+    local sep = string.find(member, '\\0', 1, true)
+    if sep then
+        local task = string.sub(member, sep + 1)
+        if redis.call('LREM', string.sub(member, 1, sep - 1), 1, task) > 0 then
+            redis.call('RPUSH', KEYS[2], task)
+            table.insert(redelivered, task)
+        end
+    end
+end
+return redelivered
+"""
+
+
+class BaseTaskQueue:
+    """Key layout and pipeline construction shared by the sync and async queues.
+
+    Pipeline builders only queue commands, so the same code serves a
+    redis.Redis and a redis.asyncio pipeline; callers execute (or await) them.
+    """
+
+    def __init__(self, conn_url, nameQueue, workerId, visibilityTimeout=3600):
+        self.conn_url = conn_url
+        self.name_queue = nameQueue
+        self.worker_id = workerId
+        self.visibility_timeout = visibilityTimeout
+        self.processing_queue = f'{nameQueue}:processing:{workerId}'
+        self.inflight_key = f'{nameQueue}:inflight'
+        self.workers_key = f'{nameQueue}:workers'
+        self.dead_key = f'{nameQueue}:dead'
+        self.held = set()
+        self.conn = None
+        self.reap_script = None
+
+    def member(self, task):
+        if isinstance(task, str):
+            task = task.encode('utf-8')
+        return self.processing_queue.encode('utf-8') + MEMBER_SEP + task
+
+    def deadline(self):
+        return time.time() + self.visibility_timeout
+
+    def trackPipe(self, task):
+        pipe = self.conn.pipeline()
+        pipe.zadd(self.inflight_key, {self.member(task): self.deadline()})
+        return pipe
+
+    def leasePipe(self):
+        """Extend the lease of every task this worker still holds, processing
+        or buffered; XX never resurrects a lease the reaper already took."""
+        pipe = self.conn.pipeline()
+        deadline = self.deadline()
+        for task in list(self.held):
+            pipe.zadd(self.inflight_key, {self.member(task): deadline}, xx=True)
+        return pipe
+
+    def forgetTask(self, pipe, task):
+        pipe.lrem(self.processing_queue, 1, task)
+        pipe.zrem(self.inflight_key, self.member(task))
+
+    def ackPipe(self, task):
+        pipe = self.conn.pipeline()
+        self.forgetTask(pipe, task)
+        return pipe
+
+    def publishPipe(self, results, resultsQueue):
+        pipe = self.conn.pipeline()
+        for task, respData in results:
+            pipe.lpush(resultsQueue, json.dumps(respData))
+            self.forgetTask(pipe, task)
+        return pipe
+
+    def deadPipe(self, task, record):
+        pipe = self.conn.pipeline()
+        pipe.lpush(self.dead_key, json.dumps(dict(
+            record, task=task.decode('utf-8') if isinstance(task, bytes) else task)))
+        self.forgetTask(pipe, task)
+        return pipe
+
+    def reapArgs(self):
+        return {'keys': [self.inflight_key, self.name_queue],
+                'args': [time.time(), REAP_LIMIT]}
+
+    def recoverPipe(self, task):
+        pipe = self.conn.pipeline()
+        pipe.zrem(self.inflight_key, self.member(task))
+        return pipe
+
+
+class RedisTaskQueue(BaseTaskQueue):
+    def __init__(self, conn_url, nameQueue, workerId=None, visibilityTimeout=3600):
+        super().__init__(conn_url, nameQueue,
+                         workerId or f'{socket.gethostname()}-{os.getpid()}',
+                         visibilityTimeout)
+
+    def getConn(self):
+        try:
+            redis_conn = redis.Redis().from_url(self.conn_url)
+            redis_conn.ping()
+            logger.info("connect to Redis server")
+            return redis_conn
+        except redis.ConnectionError as e:
+            logger.critical(f"Redis server is not running, error={e}")
+            raise
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = self.getConn()
+            self.reap_script = self.conn.register_script(REAP_SCRIPT)
+            self.recoverTasks()
+        return self.conn
+
+    def dequeueTask(self, stopEvent=None, timeout=30):
+        """Pop the next task, returns (raw task, decoded data) or None on timeout.
+
+        The raw payload is the handle for ackTask/publishResults: it is what sits
+        in the processing list, and a redelivered duplicate of the same content
+        must be acked as its own entry.
+        """
+        self.connect()
+
+        tries, i = 3, 0
+        while True:
+            try:
+                self.reapExpired()
+                logger.info('robot wait task...')
+                task = self.conn.brpoplpush(self.name_queue, self.processing_queue, timeout)
+                logger.info(f'robot pop task: {task}')
+                if task:
+                    self.trackTask(task)
+            except RedisError as e:
+                if i < tries - 1:
+                    logger.error(f'robot pop error, attempt={i+1}, error={e}')
+                    time.sleep(10)
+                    i += 1
+                    continue
+                else:
+                    logger.critical(f'robot pop error, all attempt, error={e}')
+                    raise
+
+            if not task:
+                if stopEvent is None:
+                    logger.info(f'robot pop timeout, sleep...')
+                    time.sleep(30)
+                    continue
+                return None
+
+            return task, json.loads(task)
+
+    def trackTask(self, task):
+        self.trackPipe(task).execute()
+        self.held.add(task)
+
+    def extendLeases(self):
+        if self.held:
+            self.leasePipe().execute()
+
+    def ackTask(self, task):
+        self.ackPipe(task).execute()
+        self.held.discard(task)
+        logger.info(f'task ack, task={task}')
+
+    def publishResults(self, results, resultsQueue):
+        self.publishPipe(results, resultsQueue).execute()
+        self.held.difference_update(task for task, _ in results)
+        logger.info(f'results published, cont_ids={[respData["content_id"] for _, respData in results]}')
+
+    def deadLetter(self, task, record):
+        self.deadPipe(task, record).execute()
+        self.held.discard(task)
+        logger.error(f'task dead-lettered, queue={self.dead_key}, task={task}, record={record}')
+
+    def reportHealth(self, state, processed):
+        health = {
+            'pid': os.getpid(),
+            'state': state,
+            'processed': processed,
+            'heartbeat': time.time()
+        }
+        try:
+            self.connect().hset(self.workers_key, self.worker_id, json.dumps(health))
+        except RedisError as e:
+            logger.warning(f'health report error, worker_id={self.worker_id}, error={e}')
+
+    def reapExpired(self):
+        for task in self.reap_script(**self.reapArgs()):
+            logger.warning(f'task visibility timeout, redelivered, task={task}')
+
+    def recoverTasks(self):
+        while True:
+            task = self.conn.rpoplpush(self.processing_queue, self.name_queue)
+            if task is None:
+                return
+            self.recoverPipe(task).execute()
+            logger.warning(f'task recovered from processing list, task={task}')
+
+    def enqueueTask(self, conn):
+        data = {
+            'account_id': 2,
+            'content_id': 5,
+            'content_uuid': 'qwe123',
+            'file': 'test.xml'
+        }
+
+        try:
+            conn.lpush(self.name_queue, json.dumps(data))
+        except Exception as e:
+            raise
@@ -0,0 +1,34 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import ResultBuffer
+
+
+class ResultBufferTest(unittest.TestCase):
+
+    def test_due_by_size(self):
+        buffer = ResultBuffer(maxSize=2, window=60)
+        buffer.add(1)
+        self.assertFalse(buffer.due())
+
+        buffer.add(2)
+        self.assertTrue(buffer.due())
+
+    def test_due_by_window(self):
+        buffer = ResultBuffer(maxSize=10, window=0)
+        self.assertFalse(buffer.due())
+
+        buffer.add(1)
+        self.assertTrue(buffer.due())
+
+    def test_drain(self):
+        buffer = ResultBuffer(maxSize=10, window=60)
+        buffer.add(1)
+        buffer.add(2)
+
+        self.assertEqual(buffer.drain(), [1, 2])
+        self.assertEqual(len(buffer), 0)
+        self.assertFalse(buffer.due())
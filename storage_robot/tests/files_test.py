@@ -0,0 +1,37 @@
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import unpackFile, taskFilename
+
+
+class UnpackFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.folder, 'ab', 'cd'))
+        with gzip.open(os.path.join(self.folder, 'ab', 'cd', 'blob.xml.gz'), 'wb') as f:
+            f.write(b'<a/>')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_taskFilename(self):
+        self.assertEqual(taskFilename(os.path.join('ab', 'cd', 'blob.xml'), 't1'),
+                         os.path.join('ab', 'cd', 't1-blob.xml'))
+
+    def test_unpack_per_task(self):
+        packed = os.path.join('ab', 'cd', 'blob.xml.gz')
+
+        first = unpackFile(self.folder, packed, 'gzip', taskFilename('ab/cd/blob.xml', 't1'))
+        second = unpackFile(self.folder, packed, 'gzip', taskFilename('ab/cd/blob.xml', 't2'))
+        os.remove(os.path.join(self.folder, first))
+
+        with open(os.path.join(self.folder, second), 'rb') as f:
+            self.assertEqual(f.read(), b'<a/>')
+        self.assertTrue(os.path.isfile(os.path.join(self.folder, packed)))
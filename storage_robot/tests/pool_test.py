@@ -0,0 +1,112 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import ConnectionPool
+
+
+class FakeDisconnectError(Exception):
+    pass
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, *params):
+        if not self.conn.alive:
+            raise FakeDisconnectError('connection lost')
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.opened = []
+
+        def connect():
+            conn = FakeConnection()
+            self.opened.append(conn)
+            return conn
+
+        self.pool = ConnectionPool(connect, maxSize=1, maxAge=3600,
+                                   checkInterval=0,
+                                   disconnectErrors=(FakeDisconnectError,))
+
+    def test_connection_reused(self):
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(first.rollbacks, 2)
+
+    def test_connection_recycled_after_max_age(self):
+        self.pool.max_age = -1
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+
+    def test_dead_connection_replaced(self):
+        with self.pool.connection() as first:
+            pass
+        first.alive = False
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+
+    def test_connection_discarded_on_disconnect_error(self):
+        with self.assertRaises(FakeDisconnectError):
+            with self.pool.connection() as conn:
+                raise FakeDisconnectError('connection lost')
+
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.pool.idle, [])
+
+    def test_ping_error_discards_connection(self):
+        with self.assertRaises(FakeDisconnectError):
+            with self.pool.connection() as conn:
+                conn.alive = False
+                self.pool.ping(conn)
+
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.pool.idle, [])
+
+    def test_close_all(self):
+        with self.pool.connection() as conn:
+            pass
+        self.pool.closeAll()
+
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.pool.idle, [])
@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from task_queue import RedisTaskQueue, MEMBER_SEP, REAP_SCRIPT
+
+
+class FakePipeline:
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return call
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [getattr(self.conn, name)(*args, **kwargs) for name, args, kwargs in calls]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.lists = {}
+        self.zsets = {}
+        self.hashes = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def ping(self):
+        return True
+
+    def lpush(self, key, *values):
+        self.lists.setdefault(key, [])[:0] = reversed(values)
+        return len(self.lists[key])
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+        return len(self.lists[key])
+
+    def rpoplpush(self, src, dst):
+        items = self.lists.get(src)
+        if not items:
+            return None
+        value = items.pop()
+        self.lpush(dst, value)
+        return value
+
+    def brpoplpush(self, src, dst, timeout=0):
+        return self.rpoplpush(src, dst)
+
+    def lrem(self, key, count, value):
+        items = self.lists.get(key, [])
+        if value in items:
+            items.remove(value)
+            return 1
+        return 0
+
+    def zadd(self, key, mapping, xx=False):
+        zset = self.zsets.setdefault(key, {})
+        for member, score in mapping.items():
+            if not xx or member in zset:
+                zset[member] = score
+
+    def zrem(self, key, member):
+        return int(self.zsets.get(key, {}).pop(member, None) is not None)
+
+    def zrangebyscore(self, key, low, high):
+        return [member for member, score in self.zsets.get(key, {}).items()
+                if score <= high]
+
+    def register_script(self, source):
+        assert source == REAP_SCRIPT
+
+        def reap(keys, args):
+            # mirrors REAP_SCRIPT, which runs atomically inside Redis
+            inflight, queue = keys
+            redelivered = []
+            for member in self.zrangebyscore(inflight, '-inf', args[0])[:args[1]]:
+                self.zrem(inflight, member)
+                owner, task = member.split(MEMBER_SEP, 1)
+                if self.lrem(owner.decode(), 1, task):
+                    self.rpush(queue, task)
+                    redelivered.append(task)
+            return redelivered
+        return reap
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+
+def makeTask(content_id):
+    return json.dumps({'account_id': 1, 'content_id': content_id, 'file': 'a.xml'}).encode()
+
+
+class RedisTaskQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeRedis()
+        self.queue = self.makeQueue('w1')
+
+    def makeQueue(self, workerId, visibilityTimeout=3600):
+        queue = RedisTaskQueue('redis://fake', 'tasks', workerId, visibilityTimeout)
+        queue.getConn = lambda: self.conn
+        return queue
+
+    def test_ack_after_flush(self):
+        self.conn.lpush('tasks', makeTask(1))
+
+        task, data = self.queue.dequeueTask(stopEvent=object())
+        self.assertEqual(data['content_id'], 1)
+        self.assertEqual(self.conn.lists['tasks:processing:w1'], [task])
+        self.assertIn(self.queue.member(task), self.conn.zsets['tasks:inflight'])
+
+        self.queue.publishResults([(task, {'content_id': 1, 'status': 'success'})], 'results')
+
+        self.assertEqual(self.conn.lists['tasks:processing:w1'], [])
+        self.assertEqual(self.conn.zsets['tasks:inflight'], {})
+        self.assertEqual(self.queue.held, set())
+        self.assertEqual(len(self.conn.lists['results']), 1)
+
+    def test_reap_redeliver(self):
+        self.conn.lpush('tasks', makeTask(1))
+        self.queue.visibility_timeout = -1
+        task, _ = self.queue.dequeueTask(stopEvent=object())
+
+        other = self.makeQueue('w2')
+        other.connect()
+        other.reapExpired()
+
+        self.assertEqual(self.conn.lists['tasks'], [task])
+        self.assertEqual(self.conn.lists['tasks:processing:w1'], [])
+
+        redelivered, _ = other.dequeueTask(stopEvent=object())
+        self.assertEqual(redelivered, task)
+        self.assertEqual(self.conn.lists['tasks:processing:w2'], [task])
+
+    def test_late_ack_keeps_redelivered_copy(self):
+        self.conn.lpush('tasks', makeTask(1))
+        self.queue.visibility_timeout = -1
+        task, _ = self.queue.dequeueTask(stopEvent=object())
+
+        other = self.makeQueue('w2')
+        other.connect()
+        other.reapExpired()
+        other.dequeueTask(stopEvent=object())
+        self.queue.ackTask(task)
+
+        self.assertEqual(self.conn.lists['tasks:processing:w2'], [task])
+        self.assertIn(other.member(task), self.conn.zsets['tasks:inflight'])
+
+    def test_extend_leases(self):
+        self.conn.lpush('tasks', makeTask(1))
+        self.queue.visibility_timeout = -1
+        task, _ = self.queue.dequeueTask(stopEvent=object())
+
+        self.queue.visibility_timeout = 3600
+        self.queue.extendLeases()
+        other = self.makeQueue('w2')
+        other.connect()
+        other.reapExpired()
+
+        self.assertEqual(self.conn.lists['tasks:processing:w1'], [task])
+        self.assertGreater(self.conn.zsets['tasks:inflight'][self.queue.member(task)],
+                           time.time())
+
+    def test_extend_leases_after_reap(self):
+        self.conn.lpush('tasks', makeTask(1))
+        self.queue.visibility_timeout = -1
+        self.queue.dequeueTask(stopEvent=object())
+        other = self.makeQueue('w2')
+        other.connect()
+        other.reapExpired()
+
+        self.queue.visibility_timeout = 3600
+        self.queue.extendLeases()
+
+        self.assertEqual(self.conn.zsets['tasks:inflight'], {})
+
+    def test_ack_redelivered_duplicate(self):
+        self.conn.lpush('tasks', makeTask(1))
+        self.conn.lpush('tasks', makeTask(1))
+
+        first, _ = self.queue.dequeueTask(stopEvent=object())
+        second, _ = self.queue.dequeueTask(stopEvent=object())
+
+        self.queue.ackTask(first)
+        self.queue.ackTask(second)
+        self.assertEqual(self.conn.lists['tasks:processing:w1'], [])
+
+    def test_startup_recovery(self):
+        task = makeTask(1)
+        self.conn.lpush('tasks:processing:w1', task)
+        self.conn.zadd('tasks:inflight', {self.queue.member(task): time.time() + 3600})
+
+        self.queue.connect()
+
+        self.assertEqual(self.conn.lists['tasks'], [task])
+        self.assertEqual(self.conn.lists['tasks:processing:w1'], [])
+        self.assertEqual(self.conn.zsets['tasks:inflight'], {})
+
+    def test_dead_letter(self):
+        self.conn.lpush('tasks', makeTask(1))
+        task, _ = self.queue.dequeueTask(stopEvent=object())
+
+        self.queue.deadLetter(task, {'http_status': 422, 'error': 'invalid status'})
+
+        self.assertEqual(self.conn.lists['tasks:processing:w1'], [])
+        self.assertEqual(self.conn.zsets['tasks:inflight'], {})
+        self.assertEqual(self.queue.held, set())
+        record = json.loads(self.conn.lists['tasks:dead'][0])
+        self.assertEqual(record['http_status'], 422)
+        self.assertEqual(json.loads(record['task'])['content_id'], 1)
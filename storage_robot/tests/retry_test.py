@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from requests.exceptions import ConnectionError
+from utils import retry, RetryBudget, CircuitBreaker, CircuitOpenError
+
+
+class RetryTest(unittest.TestCase):
+
+    def test_retry_until_success(self):
+        calls = []
+
+        @retry((ConnectionError,), tries=3, delay=0)
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConnectionError('down')
+            return 'ok'
+
+        self.assertEqual(flaky(), 'ok')
+        self.assertEqual(len(calls), 3)
+
+    def test_retry_stops_when_budget_exhausted(self):
+        calls = []
+        budget = RetryBudget(ratio=0, minRetries=1)
+
+        @retry((ConnectionError,), tries=4, delay=0, budget=budget)
+        def down():
+            calls.append(1)
+            raise ConnectionError('down')
+
+        self.assertRaises(ConnectionError, down)
+        self.assertEqual(len(calls), 2)
+
+        calls.clear()
+        self.assertRaises(ConnectionError, down)
+        self.assertEqual(len(calls), 1)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_after_failures(self):
+        breaker = CircuitBreaker(failureThreshold=2, resetTimeout=60)
+        breaker.recordFailure()
+        breaker.check()
+        breaker.recordFailure()
+
+        self.assertRaises(CircuitOpenError, breaker.check)
+
+    def test_half_open_after_reset_timeout(self):
+        breaker = CircuitBreaker(failureThreshold=1, resetTimeout=0)
+        breaker.recordFailure()
+
+        self.assertTrue(breaker.allow())
+        breaker.recordSuccess()
+        self.assertIsNone(breaker.opened_at)
@@ -0,0 +1,19 @@
+import os
+import sys
+import json
+import base64
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import tokenExpiry
+
+
+class TokenExpiryTest(unittest.TestCase):
+
+    def test_token_expiry(self):
+        payload = base64.urlsafe_b64encode(
+            json.dumps({'account_id': 2, 'exp': 1571234567}).encode()).rstrip(b'=')
+        token = f'header.{payload.decode()}.signature'
+
+        self.assertEqual(tokenExpiry(token), 1571234567)
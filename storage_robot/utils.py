@@ -1,22 +1,175 @@
+import os
+import gzip
+import hashlib
+import json
+import base64
 import time
+import random
+import shutil
 import logging
+from threading import Lock
 from functools import wraps
+from collections import deque
+from contextlib import contextmanager
 
 from requests.exceptions import RequestException, ConnectionError, ConnectTimeout, HTTPError
 
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
 logger = logging.getLogger('storage_robot')
 
-def retry(exceptions, tries=4, delay=5, backoff=2):
+
+def taskFilename(filename, tag):
+    """Per-task name for a local copy: workers sharing a dedup blob must not
+    write or remove each other's files."""
+    head, tail = os.path.split(filename)
+    return os.path.join(head, f'{tag}-{tail}')
+
+
+def unpackFile(folder, filename, codec, target=None):
+    target = target or os.path.splitext(filename)[0]
+    packedPath = os.path.join(folder, filename)
+    unpackedPath = os.path.join(folder, target)
+
+    with open(packedPath, 'rb') as src, open(unpackedPath, 'wb') as dst:
+        if codec == 'gzip':
+            reader = gzip.GzipFile(fileobj=src, mode='rb')
+        elif codec == 'zstd' and zstandard is not None:
+            reader = zstandard.ZstdDecompressor().stream_reader(src)
+        else:
+            raise ValueError(f'unsupported codec={codec}')
+        shutil.copyfileobj(reader, dst)
+
+    logger.info(f'file unpacked, file={filename}, codec={codec}')
+    return target
+
+
+def fileDigest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fetchFile(client, bucket, key, folder, filename):
+    path = os.path.join(folder, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    client.download_file(bucket, key, path)
+
+    logger.info(f'file fetched, bucket={bucket}, key={key}')
+    return filename
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failureThreshold=5, resetTimeout=30):
+        self.failure_threshold = failureThreshold
+        self.reset_timeout = resetTimeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError('circuit_open')
+
+    def recordSuccess(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info('circuit closed')
+            self.failures = 0
+            self.opened_at = None
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.error(f'circuit open, failures={self.failures}')
+                self.opened_at = time.monotonic()
+
+
+class RetryBudget:
+    def __init__(self, ratio=0.2, minRetries=10, window=60):
+        self.ratio = ratio
+        self.min_retries = minRetries
+        self.window = window
+        self.requests = deque()
+        self.retries = deque()
+        self.lock = Lock()
+
+    def prune(self, now):
+        for events in (self.requests, self.retries):
+            while events and now - events[0] > self.window:
+                events.popleft()
+
+    def recordRequest(self):
+        with self.lock:
+            now = time.monotonic()
+            self.prune(now)
+            self.requests.append(now)
+
+    def acquireRetry(self):
+        with self.lock:
+            now = time.monotonic()
+            self.prune(now)
+            if len(self.retries) >= max(self.min_retries, self.ratio * len(self.requests)):
+                return False
+            self.retries.append(now)
+            return True
+
+
+def tokenExpiry(token):
+    payload = token.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    return json.loads(base64.urlsafe_b64decode(payload))['exp']
+
+
+def errorMessage(response):
+    try:
+        return response.json().get('error')
+    except ValueError:
+        return None
+
+
+def permanentStatus(status):
+    """A 4xx other than auth, timeout or throttling fails the same way on retry."""
+    return 400 <= status < 500 and status not in (401, 408, 429)
+
+
+def backoffDelay(attempt, delay, backoff, maxDelay):
+    return random.uniform(0, min(maxDelay, delay * backoff ** attempt))
+
+
+def retry(exceptions, tries=4, delay=5, backoff=2, maxDelay=60, budget=None):
     def wrapper(fun):
         @wraps(fun)
         def wrapped(*args, **kwargs):
+            if budget is not None:
+                budget.recordRequest()
+
             final_excep = None
             for i in range(tries):
                 if i > 0:
-                    nonlocal delay
-                    time.sleep(delay)
-                    delay *= backoff
+                    if budget is not None and not budget.acquireRetry():
+                        logger.warning(f'retry budget exhausted, attempt={i+1}')
+                        break
+                    time.sleep(backoffDelay(i - 1, delay, backoff, maxDelay))
                 final_excep = None
                 
                 try:
@@ -24,15 +177,13 @@ def retry(exceptions, tries=4, delay=5, backoff=2):
                 except (exceptions) as e:
                     if e.__class__ == HTTPError:
                         http_status = e.response.status_code
-                        error_msg = e.response.json().get('error')
+                        error_msg = errorMessage(e.response)
 
                         if http_status >= 500:
                             logger.warning(f'''http_server_error, http_status={http_status},
                                     http_err_msg={error_msg}, attempt={i+1}, error={e}''')
                             final_excep = e
                         else:
-                            # logger.error(
-                            #     f'http_server_error, http_status={http_status}, http_err_msg={error_msg}, error={e}')
                             final_excep = e
                             break
                     else:
@@ -45,3 +196,128 @@ def retry(exceptions, tries=4, delay=5, backoff=2):
         return wrapped
     
     return wrapper
+
+
+class ConnectionPool:
+    def __init__(self, connect, maxSize=1, maxAge=3600, checkInterval=30,
+                 pingQuery='SELECT 1', disconnectErrors=()):
+        self.connect = connect
+        self.max_size = maxSize
+        self.max_age = maxAge
+        self.check_interval = checkInterval
+        self.ping_query = pingQuery
+        self.disconnect_errors = disconnectErrors
+        self.idle = []
+        self.lock = Lock()
+
+    @contextmanager
+    def connection(self):
+        conn, created, _ = self.acquire()
+        try:
+            yield conn
+        except self.disconnect_errors:
+            self.discard(conn)
+            raise
+        except Exception:
+            self.release(conn, created)
+            raise
+        else:
+            self.release(conn, created)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, created, lastUsed = self.idle.pop()
+
+            now = time.monotonic()
+            if now - created > self.max_age:
+                logger.info('db connection recycled, max age reached')
+                self.discard(conn)
+            elif now - lastUsed > self.check_interval and not self.isAlive(conn):
+                logger.warning('db connection dead, reconnect')
+                self.discard(conn)
+            else:
+                return conn, created, lastUsed
+
+        conn = self.connect()
+        logger.info('db connection open')
+        now = time.monotonic()
+        return conn, now, now
+
+    def release(self, conn, created):
+        try:
+            conn.rollback()
+        except Exception as e:
+            logger.warning(f'db connection reset error, error={e}')
+            self.discard(conn)
+            return
+
+        with self.lock:
+            if len(self.idle) < self.max_size:
+                self.idle.append((conn, created, time.monotonic()))
+                return
+        self.discard(conn)
+
+    def ping(self, conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(self.ping_query)
+            cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def isAlive(self, conn):
+        try:
+            self.ping(conn)
+            return True
+        except Exception:
+            return False
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception as e:
+            logger.warning(f'db connection close error, error={e}')
+
+    def closeAll(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _, _ in idle:
+            self.discard(conn)
+
+
+class ResultBuffer:
+    def __init__(self, maxSize, window):
+        self.max_size = maxSize
+        self.window = window
+        self.items = []
+        self.first_at = None
+
+    def add(self, item):
+        if not self.items:
+            self.first_at = time.monotonic()
+        self.items.append(item)
+
+    def due(self):
+        if not self.items:
+            return False
+        return len(self.items) >= self.max_size \
+            or time.monotonic() - self.first_at >= self.window
+
+    def full(self):
+        return len(self.items) >= self.max_size
+
+    def requeue(self, items):
+        if not self.items:
+            self.first_at = time.monotonic()
+        self.items = items + self.items
+
+    def drain(self):
+        items, self.items = self.items, []
+        self.first_at = None
+        return items
+
+    def __len__(self):
+        return len(self.items)